@@ -5,8 +5,13 @@ import subprocess
 import time
 import os
 import re
+import json
+import hashlib
+import tempfile
+import shutil
 import pkg_resources
 from microweb.uploader import upload_file, create_directory, verify_files
+from microweb.microweb import parse_template, precompiled_name, template_module_source
 
 # ANSI color codes for enhanced terminal output
 COLORS = {
@@ -49,13 +54,14 @@ def check_micropython(port):
         print_colored(f"Error checking MicroPython via mpremote: {e}. The app may be running boot.py.", color='blue')
         return False
 
-def get_remote_file_info(port):
-    """Get remote file information from ESP32 including sizes."""
+def get_remote_file_info(port, directory=None):
+    """Get remote file information from ESP32 including sizes; names are prefixed with `directory/` if given."""
     try:
-        cmd = ['mpremote', 'connect', port, 'ls']
+        cmd = ['mpremote', 'connect', port, 'ls'] + ([f':{directory}'] if directory else [])
         result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
         if result.returncode != 0:
-            print_colored(f"Error getting remote file list: {result.stderr}", color='red')
+            if not directory:  # a missing sub-folder just means nothing was uploaded there yet
+                print_colored(f"Error getting remote file list: {result.stderr}", color='red')
             return {}
         file_info = {}
         lines = result.stdout.strip().split('\n')
@@ -68,7 +74,7 @@ def get_remote_file_info(port):
                 try:
                     size = int(parts[0])
                     filename = ' '.join(parts[1:])
-                    file_info[filename] = size
+                    file_info[f"{directory}/{filename}" if directory else filename] = size
                 except ValueError:
                     continue
         return file_info
@@ -89,9 +95,10 @@ def should_upload_file(local_path, remote_filename, remote_files):
     return False, f"No change (both: {local_size} bytes)"
 
 def analyze_app_static_files(app_file):
-    """Analyze the app.py file to find static file and template references."""
+    """Analyze the app.py file to find static file, template and mounted folder references."""
     static_files = set()
     template_files = set()
+    mounts = set()
     try:
         app_dir = os.path.dirname(app_file) or '.'
         with open(app_file, 'r', encoding='utf-8') as f:
@@ -124,6 +131,9 @@ def analyze_app_static_files(app_file):
                 continue
             if len(file_path) > 2 and not file_path.startswith('/'):
                 static_files.add((url_path, file_path))
+        mount_pattern = r'app\.mount_static\s*\(\s*[\'"]([^\'"]+)[\'"]\s*,\s*[\'"]([^\'"]+)[\'"]'
+        for url_prefix, directory in re.findall(mount_pattern, filtered_content):
+            mounts.add((url_prefix, directory))
         template_pattern = r'app\.render_template\s*\(\s*[\'"]([^\'"]+)[\'"][^\)]*\)'
         template_matches = re.findall(template_pattern, filtered_content)
         for template in template_matches:
@@ -141,10 +151,10 @@ def analyze_app_static_files(app_file):
             print_colored(f"Resolved template file paths:", color='cyan')
             for template in template_files:
                 print_colored(f"  {template} {'(exists)' if os.path.exists(template) else '(missing)'}", color='cyan')
-        return static_files, template_files
+        return static_files, template_files, mounts
     except Exception as e:
         print_colored(f"Error analyzing {app_file}: {e}", color='red')
-        return set(), set()
+        return set(), set(), set()
 
 def analyze_template_static_files(template_files):
     """Analyze template files to find additional static file references."""
@@ -167,6 +177,51 @@ def analyze_template_static_files(template_files):
             print_colored(f"Error analyzing template {template_file}: {e}", color='red')
     return static_files
 
+def template_references(nodes, names=None):
+    """Names of the templates pulled in by {% include %} and {% extends %} tags in parsed template nodes."""
+    if names is None:
+        names = []
+    for node in nodes:
+        if node['type'] in ('include', 'extends'):
+            names.append(node['name'])
+        for branch in ('body', 'then_branch', 'else_branch'):
+            if node.get(branch):
+                template_references(node[branch], names)
+    return names
+
+def analyze_template_includes(template_files, app_dir):
+    """Follow include/extends tags from the given templates, recursively.
+    
+    Returns {local path: remote name} for every template found this way; names
+    are resolved like the device does, from the app folder, falling back to the
+    including template's folder.
+    """
+    included = {}
+    pending = list(template_files)
+    seen = set(os.path.normpath(path) for path in template_files)
+    while pending:
+        template_file = pending.pop()
+        if not os.path.exists(template_file):
+            continue
+        try:
+            with open(template_file, 'r', encoding='utf-8') as f:
+                names = template_references(parse_template(f.read()))
+        except (OSError, ValueError) as e:
+            print_colored(f"Warning: Could not parse {template_file} for includes: {e}", color='yellow')
+            continue
+        for name in names:
+            candidates = [os.path.join(app_dir, name), os.path.join(os.path.dirname(template_file), name)]
+            local_path = next((path for path in candidates if os.path.exists(path)), None)
+            if local_path is None:
+                print_colored(f"Warning: Template {name} included by {template_file} not found", color='yellow')
+                continue
+            local_path = os.path.normpath(local_path)
+            if local_path not in seen:
+                seen.add(local_path)
+                included[local_path] = name.lstrip('/')
+                pending.append(local_path)
+    return included
+
 def verify_static_files_exist(static_files, static_dir):
     """Verify that all required static files exist locally."""
     missing_files = []
@@ -182,6 +237,58 @@ def verify_static_files_exist(static_files, static_dir):
             missing_files.append((url_path, full_path))
     return existing_files, missing_files
 
+def mounted_dir_files(directory):
+    """(local path, relative path) of every file under a mount_static() folder, skipping dotfiles as the device does."""
+    found = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            if not name.startswith('.'):
+                local_path = os.path.join(root, name)
+                found.append((local_path, os.path.relpath(local_path, directory).replace(os.sep, '/')))
+    return found
+
+def build_static_manifest(directory):
+    """Describe a mounted folder for MicroWeb.mount_static(): size and a content-hash ETag per relative path."""
+    files = {}
+    for local_path, relative_path in mounted_dir_files(directory):
+        with open(local_path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        files[relative_path] = {
+            'size': os.path.getsize(local_path),
+            'etag': f'"{digest[:16]}"'
+        }
+    return {'files': files}
+
+def upload_static_manifest(directory, remote_dir, port):
+    """Write the manifest of a mounted folder to a temporary file and upload it as <remote_dir>/.manifest.json."""
+    manifest_dir = tempfile.mkdtemp()
+    manifest_path = os.path.join(manifest_dir, '.manifest.json')
+    try:
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(build_static_manifest(directory), f)
+        upload_file(manifest_path, port, destination=f'{remote_dir}/.manifest.json', keep_path=True)
+    finally:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        os.rmdir(manifest_dir)
+
+def precompile_template(template_file, remote_name, output_dir):
+    """Compile a template into a tpl_*.py module in output_dir, named after the template's
+    remote name as the device looks it up; returns its path, or None on errors."""
+    try:
+        # newline='' keeps CRLF line endings, so SOURCE_SIZE matches the file's size on the device
+        with open(template_file, 'r', encoding='utf-8', newline='') as f:
+            template = f.read()
+        source = template_module_source(template, remote_name)
+    except (OSError, ValueError) as e:
+        print_colored(f"⚠️  Could not precompile {template_file}: {e}", color='yellow')
+        return None
+    module_path = os.path.join(output_dir, precompiled_name(remote_name) + '.py')
+    with open(module_path, 'w', encoding='utf-8') as f:
+        f.write(source)
+    return module_path
+
 def upload_boot_py(port, module_name):
     """Create and upload boot.py that imports the specified app module."""
     boot_content = f"import {module_name}\n"
@@ -303,7 +410,8 @@ def flash(port, erase, esp8266, firmware):
 @click.option('--timeout', default=3600, show_default=True, help='Timeout seconds for running app')
 @click.option('--add-boot', is_flag=True, help='Add boot.py that imports the app to run it on boot')
 @click.option('--remove-boot', is_flag=True, help='Remove boot.py from the ESP32')
-def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remove_boot):
+@click.option('--no-precompile', is_flag=True, help='Upload templates only, without precompiled tpl_*.py modules')
+def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remove_boot, no_precompile):
     """Upload and execute a file on the ESP32 (only uploads changed files)."""
     if not file.endswith('.py'):
         print_colored("Error: File must have a .py extension.", color='red')
@@ -316,7 +424,18 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
         print_colored("Error: --add-boot and --remove-boot options cannot be used together.", color='red')
         return
     print_colored(f"Analyzing {file} for static file, template, and library/model dependencies...", color='blue')
-    static_files, template_files = analyze_app_static_files(file)
+    static_files, template_files, mounts = analyze_app_static_files(file)
+    # --- Folders served with app.mount_static() are uploaded whole, with a manifest ---
+    mounted_dirs = []  # (local directory, remote directory)
+    for url_prefix, directory in sorted(mounts):
+        remote_dir = os.path.normpath(directory.lstrip('/')).replace(os.sep, '/')
+        local_dir = os.path.join(os.path.dirname(file), remote_dir)
+        if not os.path.isdir(local_dir):
+            print_colored(f"Error: Folder {local_dir} mounted at {url_prefix} not found.", color='red')
+            return
+        print_colored(f"Mounted folder: {url_prefix} -> {local_dir} ({len(mounted_dir_files(local_dir))} files)", color='cyan')
+        mounted_dirs.append((local_dir, remote_dir))
+    mounted_paths = set(os.path.abspath(local_dir) for local_dir, remote_dir in mounted_dirs)
     # --- Find templates in ./ and ./static ---
     found_templates = set()
     for folder in [os.path.dirname(file), static]:
@@ -327,14 +446,17 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
     for tfile in found_templates:
         if tfile not in template_files:
             template_files.add(tfile)
+    # --- Templates pulled in by include/extends keep the name they are referenced by ---
+    template_names = analyze_template_includes(template_files, os.path.dirname(file))
+    template_files.update(template_names)
     if template_files:
         print_colored(f"Found template files: {', '.join(os.path.basename(t) for t in template_files)}", color='cyan')
         template_static_files = analyze_template_static_files(template_files)
         static_files.update(template_static_files)
-    # --- Find static files in ./ and ./static ---
+    # --- Find static files in ./ and ./static (mounted folders are uploaded as a whole) ---
     found_static = set()
     for folder in [os.path.dirname(file), static]:
-        if os.path.isdir(folder):
+        if os.path.isdir(folder) and os.path.abspath(folder) not in mounted_paths:
             for entry in os.listdir(folder):
                 if entry.endswith(('.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.ico', '.svg', '.webp')):
                     found_static.add(('/' + entry, entry))
@@ -354,6 +476,10 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
                 print_colored(f"  {url_path} -> {file_full_path} (NOT FOUND)", color='red')
             print_colored("\nPlease create these files or update your app.py file or --static folder.", color='yellow')
             return
+        # Precompressed siblings (style.css.gz) are uploaded too; MicroWeb serves them to gzip-capable clients
+        for url_path, file_full_path in list(existing_files):
+            if os.path.exists(file_full_path + '.gz'):
+                existing_files.append((url_path + '.gz', file_full_path + '.gz'))
         print_colored(f"\nAll {len(existing_files)} static files found locally:", color='green')
         for url_path, file_full_path in existing_files:
             file_size = os.path.getsize(file_full_path)
@@ -415,16 +541,46 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
         else:
             files_skipped.append((main_filename, reason))
         template_uploads = []
+        remote_templates = dict(remote_files)
+        for template_dir in sorted(set(name.rsplit('/', 1)[0] for name in template_names.values() if '/' in name)):
+            remote_templates.update(get_remote_file_info(port, template_dir))
         for template_file in template_files:
             if os.path.exists(template_file):
-                remote_name = os.path.basename(template_file)
-                should_upload, reason = should_upload_file(template_file, remote_name, remote_files)
+                remote_name = template_names.get(template_file, os.path.basename(template_file))
+                should_upload, reason = should_upload_file(template_file, remote_name, remote_templates)
                 if force or should_upload:
                     template_uploads.append((template_file, remote_name, reason))
                 else:
                     files_skipped.append((remote_name, reason))
             else:
                 print_colored(f"farning Fajling: Template file {template_file} not found locally, skipping upload.", color='yellow')
+        # Templates are also compiled here so the device does not parse them on the first request
+        precompiled_uploads = []
+        precompile_dir = tempfile.mkdtemp()
+        if not no_precompile:
+            # Names such as parts_nav.html and parts/nav.html share a module name; parse those on the device
+            module_templates = {}
+            for template_file in template_files:
+                remote_name = template_names.get(template_file, os.path.basename(template_file))
+                module_templates.setdefault(precompiled_name(remote_name), set()).add(remote_name)
+            for template_file in template_files:
+                if not os.path.exists(template_file):
+                    continue
+                remote_name = template_names.get(template_file, os.path.basename(template_file))
+                if len(module_templates[precompiled_name(remote_name)]) > 1:
+                    print_colored(f"⚠️  Not precompiling {remote_name}: its module name clashes with "
+                                  f"{', '.join(sorted(module_templates[precompiled_name(remote_name)] - {remote_name}))}",
+                                  color='yellow')
+                    continue
+                module_path = precompile_template(template_file, remote_name, precompile_dir)
+                if module_path is None:
+                    continue
+                remote_name = os.path.basename(module_path)
+                should_upload, reason = should_upload_file(module_path, remote_name, remote_files)
+                if force or should_upload:
+                    precompiled_uploads.append((module_path, remote_name, reason))
+                else:
+                    files_skipped.append((remote_name, reason))
         static_uploads = []
         if existing_files:
             for url_path, file_full_path in existing_files:
@@ -434,6 +590,23 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
                     static_uploads.append((file_full_path, filename, reason))
                 else:
                     files_skipped.append((f"static/{filename}", reason))
+        mount_uploads = []  # (local path, remote path, reason)
+        manifest_uploads = []  # (local directory, remote directory)
+        for local_dir, remote_dir in mounted_dirs:
+            remote_mounted = {}
+            for sub_dir in sorted(set(os.path.dirname(relative_path) for _, relative_path in mounted_dir_files(local_dir))):
+                remote_mounted.update(get_remote_file_info(port, f"{remote_dir}/{sub_dir}" if sub_dir else remote_dir))
+            changed = False
+            for local_path, relative_path in mounted_dir_files(local_dir):
+                remote_path = f"{remote_dir}/{relative_path}"
+                should_upload, reason = should_upload_file(local_path, remote_path, remote_mounted)
+                if force or should_upload:
+                    mount_uploads.append((local_path, remote_path, reason))
+                    changed = True
+                else:
+                    files_skipped.append((remote_path, reason))
+            if changed or f"{remote_dir}/.manifest.json" not in remote_mounted:
+                manifest_uploads.append((local_dir, remote_dir))
         lib_uploads = []
         if lib_files:
             for lib_file in lib_files:
@@ -446,7 +619,8 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
                         lib_uploads.append((lib_file, filename, relative_path, reason))
                     else:
                         files_skipped.append((remote_name, reason))
-        total_uploads = len(files_to_upload) + len(template_uploads) + len(static_uploads) + len(lib_uploads)
+        total_uploads = (len(files_to_upload) + len(template_uploads) + len(precompiled_uploads) +
+                         len(static_uploads) + len(mount_uploads) + len(manifest_uploads) + len(lib_uploads))
         if files_skipped:
             print_colored(f"\n📋 Files skipped ({len(files_skipped)}):", color='yellow')
             for filename, reason in files_skipped:
@@ -461,8 +635,14 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
                 print_colored(f"  📁 {remote_name}: {reason}", color='cyan')
             for template_file, remote_name, reason in template_uploads:
                 print_colored(f"  📄 {remote_name}: {reason}", color='cyan')
+            for module_path, remote_name, reason in precompiled_uploads:
+                print_colored(f"  ⚙️  {remote_name}: {reason}", color='cyan')
             for local_path, filename, reason in static_uploads:
                 print_colored(f"  🎨 static/{filename}: {reason}", color='cyan')
+            for local_path, remote_path, reason in mount_uploads:
+                print_colored(f"  🎨 {remote_path}: {reason}", color='cyan')
+            for local_dir, remote_dir in manifest_uploads:
+                print_colored(f"  🗂️  {remote_dir}/.manifest.json: folder index", color='cyan')
             for lib_file, filename, relative_path, reason in lib_uploads:
                 print_colored(f"  📚 {relative_path}: {reason}", color='cyan')
         upload_count = 0
@@ -472,8 +652,17 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
             upload_count += 1
         for template_file, remote_name, reason in template_uploads:
             print_colored(f"⬆️  Uploading template: {remote_name}...", color='cyan')
-            upload_file(template_file, port, destination=remote_name)
+            if '/' in remote_name:
+                parts = remote_name.split('/')[:-1]
+                for depth in range(1, len(parts) + 1):
+                    create_directory('/'.join(parts[:depth]), port)
+            upload_file(template_file, port, destination=remote_name, keep_path=True)
             upload_count += 1
+        for module_path, remote_name, reason in precompiled_uploads:
+            print_colored(f"⬆️  Uploading precompiled template: {remote_name}...", color='cyan')
+            upload_file(module_path, port, destination=remote_name)
+            upload_count += 1
+        shutil.rmtree(precompile_dir, ignore_errors=True)
         if static_uploads:
             print_colored("📁 Creating static directory on ESP32...", color='blue')
             create_directory('static', port)
@@ -481,6 +670,21 @@ def run(file, port, check_only, static, force, no_stop, timeout, add_boot, remov
                 print_colored(f"⬆️  Uploading static file: static/{filename}...", color='cyan')
                 upload_file(file_full_path, port, destination=f"static/{filename}")
                 upload_count += 1
+        if mount_uploads:
+            for dir_name in sorted(set(remote_path.rsplit('/', 1)[0] for _, remote_path, _ in mount_uploads)):
+                parts = dir_name.split('/')
+                for depth in range(1, len(parts) + 1):
+                    create_directory('/'.join(parts[:depth]), port)
+            for local_path, remote_path, reason in mount_uploads:
+                print_colored(f"⬆️  Uploading static file: {remote_path}...", color='cyan')
+                upload_file(local_path, port, destination=remote_path, keep_path=True)
+                upload_count += 1
+        for local_dir, remote_dir in manifest_uploads:
+            # Lets app.mount_static() index the folder without walking the filesystem on boot
+            print_colored(f"⬆️  Uploading static manifest: {remote_dir}/.manifest.json...", color='cyan')
+            create_directory(remote_dir, port)
+            upload_static_manifest(local_dir, remote_dir, port)
+            upload_count += 1
         if lib_uploads:
             lib_dirs = set(os.path.dirname(relative_path) for _, _, relative_path, _ in lib_uploads)
             for dir_name in lib_dirs:
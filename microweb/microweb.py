@@ -1,16 +1,369 @@
-import usocket as socket
-import ujson
-import ure
+try:
+    import usocket as socket
+except ImportError:
+    import socket
+try:
+    import ujson
+except ImportError:
+    import json as ujson
+try:
+    import ure
+except ImportError:
+    import re as ure
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+try:
+    import uselect as select
+except ImportError:
+    import select
+try:
+    import uerrno as errno
+except ImportError:
+    import errno
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
 import gc
-import wifi
 import os
+import sys
+import time
+try:
+    import wifi
+except ImportError:
+    wifi = None
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    # CPython has no ticks_*; a monotonic millisecond clock does the same job
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+    
+    def ticks_diff(end, start):
+        return end - start
 
 class Request:
-    def __init__(self, method, path, query_params, post_data):
+    def __init__(self, method, path, query_params, post_data=None, headers=None, version='HTTP/1.1', body=None):
         self.method = method
         self.path = path
         self.query_params = query_params
-        self.form = post_data
+        self.headers = headers or {}  # lower-cased header names
+        self.version = version
+        self.params = {}  # named route parameters, e.g. {'id': 5} for /user/<int:id>
+        self._form = post_data
+        self._files = None
+        self._body = body
+        self._read = None  # body source: read(n) -> bytes, b'' once the body is exhausted
+        self.max_body_size = None
+        self.upload_dir = 'uploads'
+    
+    @property
+    def form(self):
+        """Parsed JSON, urlencoded or multipart POST fields, read from the body on first access."""
+        if self._form is None:
+            content_type = self.headers.get('content-type', '')
+            if 'multipart/form-data' in content_type:
+                self.parse_multipart()
+            else:
+                self._form = parse_form(self.method, content_type, self.body)
+        return self._form
+    
+    @form.setter
+    def form(self, value):
+        self._form = value
+    
+    @property
+    def body(self):
+        """The whole request body as bytes, read from the connection on first access."""
+        if self._body is None:
+            length = int(self.headers.get('content-length', 0) or 0)
+            if self.max_body_size is not None and length > self.max_body_size:
+                raise BodyTooLarge(f'Request body too large ({length} bytes); use req.stream()')
+            chunks = []
+            total = 0
+            for chunk in self.stream():
+                total += len(chunk)
+                if self.max_body_size is not None and total > self.max_body_size:
+                    raise BodyTooLarge('Request body too large; use req.stream()')
+                chunks.append(chunk)
+            self._body = b''.join(chunks)
+        return self._body
+    
+    @property
+    def files(self):
+        """Uploaded files of a multipart request: {field: {'filename', 'path', 'size', 'content_type'}}."""
+        if self._files is None:
+            if 'multipart/form-data' in self.headers.get('content-type', ''):
+                self.parse_multipart()
+            else:
+                self._files = {}
+        return self._files
+    
+    def parse_multipart(self, chunk_size=512):
+        """Stream a multipart/form-data body, saving file parts under upload_dir as they arrive."""
+        parser = MultipartParser(multipart_boundary(self.headers.get('content-type', '')),
+                                 self.upload_dir, self.max_body_size)
+        for chunk in self.stream(chunk_size):
+            parser.feed(chunk)
+        self.finish_multipart(parser)
+    
+    def finish_multipart(self, parser):
+        """Close a MultipartParser fed with this request's body and take its fields and files."""
+        parser.close()
+        self._form = parser.fields
+        self._files = parser.files
+    
+    def stream(self, chunk_size=512):
+        """Yield the body in chunks of at most chunk_size bytes without buffering all of it."""
+        if self._body is not None:
+            body = memoryview(self._body)
+            for pos in range(0, len(body), chunk_size):
+                yield bytes(body[pos:pos + chunk_size])
+            return
+        if self._read is None:
+            return
+        while True:
+            chunk = self._read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def parse_form(method, content_type, body):
+    """Decode a JSON or application/x-www-form-urlencoded POST body into a dict."""
+    post_data = {}
+    if method != 'POST' or not body:
+        return post_data
+    body = body.decode('utf-8') if isinstance(body, (bytes, bytearray)) else body
+    if 'application/json' in content_type:
+        try:
+            post_data = ujson.loads(body)
+        except:
+            post_data = {}
+    elif 'application/x-www-form-urlencoded' in content_type:
+        for param in body.split('&'):
+            if '=' in param:
+                key, value = param.split('=', 1)
+                post_data[key] = value.replace('%20', ' ')
+    return post_data
+
+def multipart_boundary(content_type):
+    for param in content_type.split(';'):
+        param = param.strip()
+        if param.startswith('boundary='):
+            return param[9:].strip('"')
+    raise ValueError('Missing multipart boundary')
+
+def safe_filename(filename):
+    """Strip any client-supplied directory part from an upload's file name."""
+    filename = filename.replace('\\', '/').split('/')[-1]
+    if filename in ('', '.', '..'):
+        return 'upload'
+    return filename
+
+class MultipartParser:
+    """Incremental multipart/form-data parser.
+    
+    feed() accepts the body in arbitrary pieces; file parts are written to
+    upload_dir as they are parsed, so only about one piece is held in memory.
+    Text fields are collected in `fields` (each capped at max_field_size).
+    """
+    def __init__(self, boundary, upload_dir='uploads', max_field_size=16384):
+        # The body starts with '--boundary'; prefixing CRLF makes every delimiter alike
+        self.delimiter = b'\r\n--' + boundary.encode('utf-8')
+        self.upload_dir = upload_dir
+        self.max_field_size = max_field_size
+        self.buffer = b'\r\n'
+        self.state = 'preamble'
+        self.fields = {}
+        self.files = {}
+        self.part_name = None
+        self.part_file = None
+        self.part_info = None
+        self.part_data = None
+        self.part_size = 0
+    
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.state == 'preamble' or self.state == 'data':
+                pos = self.buffer.find(self.delimiter)
+                if pos == -1:
+                    # Keep a tail that may hold the start of a split delimiter
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        self.write_part(self.buffer[:-keep])
+                        self.buffer = self.buffer[-keep:]
+                    return
+                self.write_part(self.buffer[:pos])
+                self.end_part()
+                self.buffer = self.buffer[pos + len(self.delimiter):]
+                self.state = 'boundary'
+            elif self.state == 'boundary':
+                if len(self.buffer) < 2:
+                    return
+                if self.buffer[:2] == b'--':
+                    self.state = 'end'
+                    self.buffer = b''
+                    return
+                self.buffer = self.buffer[2:]  # CRLF before the part headers
+                self.state = 'headers'
+            elif self.state == 'headers':
+                pos = self.buffer.find(b'\r\n\r\n')
+                if pos == -1:
+                    if len(self.buffer) > 1024:
+                        raise ValueError('Multipart part headers too large')
+                    return
+                self.start_part(self.buffer[:pos].decode('utf-8'))
+                self.buffer = self.buffer[pos + 4:]
+                self.state = 'data'
+            else:
+                self.buffer = b''
+                return
+    
+    def start_part(self, header_text):
+        name = None
+        filename = None
+        content_type = 'application/octet-stream'
+        for line in header_text.split('\r\n'):
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            key = key.strip().lower()
+            if key == 'content-disposition':
+                for param in value.split(';'):
+                    param = param.strip()
+                    if param.startswith('name='):
+                        name = param[5:].strip('"')
+                    elif param.startswith('filename='):
+                        filename = param[9:].strip('"')
+            elif key == 'content-type':
+                content_type = value.strip()
+        
+        self.part_name = name
+        self.part_size = 0
+        if filename is None:
+            self.part_data = []
+        elif filename:
+            try:
+                os.mkdir(self.upload_dir)
+            except OSError:
+                pass  # already exists
+            path = self.upload_dir + '/' + safe_filename(filename)
+            self.part_file = open(path, 'wb')
+            self.part_info = {'filename': filename, 'path': path, 'size': 0,
+                              'content_type': content_type}
+        # An empty filename means no file was chosen: the part is skipped
+    
+    def write_part(self, data):
+        if not data:
+            return
+        if self.part_file is not None:
+            self.part_file.write(data)
+            self.part_info['size'] += len(data)
+        elif self.part_data is not None:
+            self.part_data.append(data)
+            self.part_size += len(data)
+            if self.part_size > self.max_field_size:
+                raise ValueError(f'Multipart field {self.part_name} too large')
+    
+    def end_part(self):
+        if self.part_file is not None:
+            self.part_file.close()
+            self.files[self.part_name] = self.part_info
+        elif self.part_data is not None and self.part_name is not None:
+            self.fields[self.part_name] = b''.join(self.part_data).decode('utf-8')
+        self.part_file = None
+        self.part_info = None
+        self.part_data = None
+    
+    def close(self):
+        """Finish parsing; closes a file left open by a truncated body."""
+        if self.part_file is not None:
+            self.part_file.close()
+            self.part_file = None
+        if self.state != 'end':
+            raise ValueError('Incomplete multipart body')
+
+STATUS_TEXT = {
+    200: 'OK',
+    206: 'Partial Content',
+    302: 'Found',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+# Status lines are built once at import instead of on every response
+STATUS_LINES = {}
+for _status, _text in STATUS_TEXT.items():
+    STATUS_LINES[_status] = f'HTTP/1.1 {_status} {_text}\r\n'
+
+def status_line(status):
+    line = STATUS_LINES.get(status)
+    if line is None:
+        line = f'HTTP/1.1 {status} OK\r\n'
+    return line
+
+# Bodies up to this size go out in the same write as their headers
+COALESCE_SIZE = 1460
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def http_date(timestamp):
+    """Format a timestamp as an HTTP date, e.g. 'Sun, 06 Nov 1994 08:49:37 GMT'."""
+    gmtime = getattr(time, 'gmtime', None) or time.localtime
+    t = gmtime(timestamp)
+    return f'{WEEKDAYS[t[6]]}, {t[2]:02d} {MONTHS[t[1] - 1]} {t[0]} {t[3]:02d}:{t[4]:02d}:{t[5]:02d} GMT'
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value lists etag (weak comparison) or is '*'."""
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag or candidate == '*':
+            return True
+    return False
+
+def parse_range(range_header, size):
+    """Parse a single 'bytes=' range against a file of `size` bytes.
+    
+    Returns (start, end) with end inclusive, False when the range cannot be
+    satisfied, or None when the header should be ignored (malformed, another
+    unit, or several ranges) and the whole file served.
+    """
+    if not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    spec = range_header[6:].strip().split('-')
+    if len(spec) != 2:
+        return None
+    try:
+        if not spec[0]:
+            # Suffix range: the last N bytes
+            suffix = int(spec[1])
+            if suffix <= 0 or size == 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(spec[0])
+        end = int(spec[1]) if spec[1] else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
 
 class Response:
     def __init__(self, content, status=200, content_type='text/html', headers=None):
@@ -19,31 +372,609 @@ class Response:
         self.content_type = content_type
         self.headers = headers or {}
         self.headers['Access-Control-Allow-Origin'] = '*'
+        self.chunked = True  # cleared for HTTP/1.0 clients, which get a close-delimited body
     
-    def to_http_response(self):
-        status_text = {
-            200: 'OK', 
-            404: 'Not Found', 
-            405: 'Method Not Allowed', 
-            500: 'Internal Server Error',
-            302: 'Found'
-        }
+    def is_streaming(self):
+        """True when content is a generator/iterator to be sent piece by piece."""
+        content = self.content
+        return not isinstance(content, (str, bytes, bytearray, memoryview)) and \
+            (hasattr(content, 'send') or hasattr(content, '__next__'))
+    
+    def body_bytes(self):
+        """The body as a bytes-like object; binary content is passed through uncopied."""
+        content = self.content
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return content
+        if not isinstance(content, str):
+            content = str(content)
+        return content.encode('utf-8')
+    
+    def to_http_response(self, keep_alive=None):
+        """The complete response as bytes (the server writes header and body separately)."""
+        body = self.body_bytes()
+        return self.header_block(keep_alive, len(body)) + bytes(body)
+    
+    def header_block(self, keep_alive=None, body_length=None):
+        """Status line and headers as bytes; without body_length a streamed body is announced."""
+        parts = [status_line(self.status), 'Content-Type: ', self.content_type, '\r\n']
         
-        response = f'HTTP/1.1 {self.status} {status_text.get(self.status, "OK")}\r\n'
-        response += f'Content-Type: {self.content_type}\r\n'
+        if body_length is None:
+            if self.chunked:
+                parts.append('Transfer-Encoding: chunked\r\n')
+        elif 'Content-Length' not in self.headers:
+            parts.append(f'Content-Length: {body_length}\r\n')
+        if keep_alive is not None:
+            parts.append(connection_header(keep_alive))
         
         for key, value in self.headers.items():
-            response += f'{key}: {value}\r\n'
+            parts.append(f'{key}: {value}\r\n')
+        
+        parts.append('\r\n')
+        return ''.join(parts).encode('utf-8')
+    
+    def iter_body(self):
+        """Yield the encoded pieces of a streaming body, with chunked framing if enabled."""
+        for piece in self.content:
+            if isinstance(piece, str):
+                piece = piece.encode('utf-8')
+            if not piece:
+                continue  # an empty chunk would terminate the chunked body
+            if self.chunked:
+                # One write per chunk: separate tiny writes would stall on Nagle/delayed ACK
+                yield ('%x\r\n' % len(piece)).encode('utf-8') + piece + b'\r\n'
+            else:
+                yield piece
+        if self.chunked:
+            yield b'0\r\n\r\n'
+
+# Longest the blocking server waits for the next request on an idle kept-alive connection
+SYNC_KEEP_ALIVE_IDLE = 0.5
+
+CONNECTION_KEEP_ALIVE = 'Connection: keep-alive\r\n'
+CONNECTION_CLOSE = 'Connection: close\r\n'
+
+def connection_header(keep_alive):
+    return CONNECTION_KEEP_ALIVE if keep_alive else CONNECTION_CLOSE
+
+# Endings appended to a prebuilt header block, keyed by keep_alive
+HEAD_ENDINGS = {None: b'\r\n', True: b'Connection: keep-alive\r\n\r\n', False: b'Connection: close\r\n\r\n'}
+
+def header_value(header_text, name):
+    """Return a header's value from a raw request header block, or None.
+    
+    Matches the canonical and lower-case spellings without copying the block.
+    """
+    pos = header_text.find('\r\n' + name + ':')
+    if pos == -1:
+        pos = header_text.find('\r\n' + name.lower() + ':')
+        if pos == -1:
+            return None
+    start = pos + len(name) + 3
+    return header_text[start:header_text.find('\r\n', start)].strip()
+
+def content_length(header_text):
+    """Return the Content-Length declared in a request header block (0 if absent)."""
+    try:
+        return int(header_value(header_text, 'Content-Length') or 0)
+    except ValueError:
+        return 0
+
+def find_header_end(buf, start, end):
+    """Return the index just past the blank line in buf[start:end], or -1.
+    
+    Scans byte by byte (bytearray has no find() on MicroPython) so callers can
+    resume from where the previous search stopped.
+    """
+    i = start if start > 3 else 3
+    while i < end:
+        if buf[i] == 10 and buf[i - 1] == 13 and buf[i - 2] == 10 and buf[i - 3] == 13:
+            return i + 1
+        i += 1
+    return -1
+
+def recv_into(conn, buf):
+    """recv_into() where available (CPython), readinto() on MicroPython sockets."""
+    if hasattr(conn, 'recv_into'):
+        return conn.recv_into(buf)
+    return conn.readinto(buf) or 0
+
+class HeaderTooLarge(Exception):
+    pass
+
+class BodyTooLarge(Exception):
+    pass
+
+class RequestReader:
+    """Preallocated receive buffer reused for every request on the blocking server.
+    
+    Request headers must fit in the buffer. The body is not read up front:
+    read_body() pulls it through the same buffer on demand, decoding chunked
+    transfer encoding. Bytes received past the end of a request stay in place
+    for the next request on a persistent connection.
+    """
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.conn = None
+        self.reset()
+    
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.body_left = 0      # bytes left in the body (or current chunk)
+        self.chunked = False
+        self.chunk_started = False
+        self.body_done = True
+    
+    def compact(self):
+        """Move unread bytes to the front of the buffer."""
+        pending = self.end - self.start
+        if pending and self.start:
+            self.buf[:pending] = self.mv[self.start:self.end]
+        self.start = 0
+        self.end = pending
+    
+    def fill(self):
+        """Receive more bytes after the unread data; returns False on EOF or timeout."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            self.compact()
+        try:
+            n = recv_into(self.conn, self.mv[self.end:])
+        except:
+            n = 0
+        self.end += n
+        return n > 0
+    
+    def read_request(self, conn):
+        """Read one request's headers; returns their text, '' on EOF/timeout, or raises HeaderTooLarge."""
+        self.conn = conn
+        self.compact()
         
-        response += '\r\n'
-        response += str(self.content)
+        scan = 0
+        while True:
+            header_end = find_header_end(self.buf, scan, self.end)
+            if header_end != -1:
+                break
+            if self.end == len(self.buf):
+                self.reset()
+                raise HeaderTooLarge()
+            scan = self.end
+            try:
+                n = recv_into(conn, self.mv[self.end:])
+            except:
+                n = 0
+            if not n:
+                # Connection closed or timed out: hand over whatever arrived
+                request = str(self.mv[:self.end], 'utf-8')
+                self.reset()
+                return request
+            self.end += n
         
-        return response
+        header_text = str(self.mv[:header_end], 'utf-8')
+        self.start = header_end
+        transfer_encoding = header_value(header_text, 'Transfer-Encoding')
+        self.chunked = transfer_encoding is not None and 'chunked' in transfer_encoding.lower()
+        self.chunk_started = False
+        self.body_left = 0 if self.chunked else content_length(header_text)
+        self.body_done = not self.chunked
+        return header_text
+    
+    def readline(self):
+        """Read a CRLF-terminated line of the chunked framing; None on EOF."""
+        while True:
+            for i in range(self.start, self.end):
+                if self.buf[i] == 10:
+                    line = str(self.mv[self.start:i], 'utf-8').strip()
+                    self.start = i + 1
+                    return line
+            if self.start == 0 and self.end == len(self.buf):
+                return None  # framing line longer than the buffer
+            if not self.fill():
+                return None
+    
+    def read_body(self, n):
+        """Return up to n bytes of the current request body; b'' once it is exhausted."""
+        while self.body_left == 0:
+            if self.body_done:
+                return b''
+            if self.chunk_started and self.readline() is None:  # CRLF after the previous chunk
+                self.body_done = True
+                return b''
+            line = self.readline()
+            self.chunk_started = True
+            try:
+                size = int(line.split(';')[0], 16)
+            except:
+                size = 0
+            if size == 0:
+                # Last chunk: skip any trailer headers up to the blank line
+                while line:
+                    line = self.readline()
+                self.body_done = True
+                return b''
+            self.body_left = size
+        
+        if self.start == self.end and not self.fill():
+            self.body_left = 0
+            self.body_done = True
+            return b''
+        take = min(n, self.body_left, self.end - self.start)
+        data = bytes(self.mv[self.start:self.start + take])
+        self.start += take
+        self.body_left -= take
+        return data
+    
+    def body_fits(self, limit):
+        """Whether the unread body is known to be at most limit bytes; never for an open chunked body."""
+        return self.body_done and self.body_left <= limit
+    
+    def drain_body(self, limit):
+        """Discard the unread rest of the body; False if more than limit bytes remain."""
+        drained = 0
+        while self.body_left or not self.body_done:
+            if self.body_left > limit - drained:
+                return False
+            chunk = self.read_body(len(self.buf))
+            if not chunk:
+                break
+            drained += len(chunk)
+        return True
+
+class PollConnection:
+    """State of one client on the select.poll server (see MicroWeb.run_poll).
+    
+    `state` moves through 'headers' (waiting for the blank line), 'body'
+    (collecting a Content-Length or chunked body, or feeding a multipart
+    upload to disk), 'write' (sending the header block and in-memory body)
+    and 'stream' (pulling file or generator chunks as the socket drains).
+    """
+    def __init__(self, sock, size):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.end = 0            # bytes buffered in buf
+        self.scan = 0           # header search resumes here
+        self.state = 'headers'
+        self.events = 0         # poll mask currently registered
+        self.req = None
+        self.body = None        # bytearray being filled, or a MultipartParser
+        self.body_left = 0      # bytes left in the body (or current chunk)
+        self.chunk_state = None  # 'size', 'data', 'crlf' or 'trailer' for chunked bodies
+        self.out = None         # memoryview of bytes still to send
+        self.source = None      # iterator of further response chunks
+        self.keep_alive = False
+        self.served = 0
+        self.last_active = ticks_ms()
+    
+    def consume(self, n):
+        """Drop n bytes from the front of the buffer."""
+        rest = self.end - n
+        if rest:
+            self.buf[:rest] = self.mv[n:self.end]
+        self.end = rest
+    
+    def readline(self):
+        """Take a CRLF-terminated line from the buffer; None until one has arrived."""
+        for i in range(self.end):
+            if self.buf[i] == 10:
+                line = str(self.mv[:i], 'utf-8').strip()
+                self.consume(i + 1)
+                return line
+        if self.end == len(self.buf):
+            raise ValueError('Chunk framing line too long')
+        return None
+    
+    def store(self, data, limit):
+        if isinstance(self.body, MultipartParser):
+            self.body.feed(bytes(data))
+        else:
+            if len(self.body) + len(data) > limit:
+                raise BodyTooLarge()
+            self.body.extend(data)
+    
+    def feed_body(self, limit):
+        """Move buffered body bytes into self.body; True once the body is complete."""
+        if self.chunk_state is None:
+            take = min(self.end, self.body_left)
+            if take:
+                self.store(self.mv[:take], limit)
+                self.consume(take)
+                self.body_left -= take
+            return self.body_left == 0
+        
+        while True:
+            if self.chunk_state == 'data':
+                take = min(self.end, self.body_left)
+                if take:
+                    self.store(self.mv[:take], limit)
+                    self.consume(take)
+                    self.body_left -= take
+                if self.body_left:
+                    return False
+                self.chunk_state = 'crlf'
+                continue
+            
+            line = self.readline()
+            if line is None:
+                return False
+            if self.chunk_state == 'size':
+                size = int(line.split(';')[0], 16)
+                if size == 0:
+                    self.chunk_state = 'trailer'
+                else:
+                    self.body_left = size
+                    self.chunk_state = 'data'
+            elif self.chunk_state == 'crlf':
+                self.chunk_state = 'size'
+            elif not line:
+                return True  # blank line after the last chunk and any trailers
+
+def poll_key(sock):
+    """What poll() reports for a socket: CPython gives file descriptors, MicroPython the socket objects."""
+    return sock.fileno() if hasattr(sock, 'fileno') else sock
+
+def file_chunks(file_path, start, length, size=1024):
+    """Yield `length` bytes of a file from `start`, `size` bytes at a time."""
+    with open(file_path, 'rb') as f:
+        if start:
+            f.seek(start)
+        while length:
+            chunk = f.read(min(size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
 
 class FileResponse:
-    def __init__(self, file_path, content_type):
+    def __init__(self, file_path, content_type, content_encoding=None, vary=False, cache_control=None):
         self.file_path = file_path
         self.content_type = content_type
+        self.content_encoding = content_encoding  # e.g. 'gzip' for a precompressed .gz variant
+        self.vary = vary  # True when a compressed variant exists, so caches key on Accept-Encoding
+        self.cache_control = cache_control  # Cache-Control value; None or '' sends no header
+        self.if_none_match = None  # conditional request headers, copied from the request
+        self.if_modified_since = None
+        self.range = None  # Range / If-Range request headers
+        self.if_range = None
+        # Known up front for files indexed by mount_static(), saving the stat
+        self.size = None
+        self.mtime = 0
+        self.etag = None
+        self.head = None  # prebuilt 200 header block, without Connection or the blank line
+
+def accepts_gzip(accept_encoding):
+    """True if an Accept-Encoding header value allows gzip."""
+    for token in accept_encoding.split(','):
+        parts = token.split(';')
+        if parts[0].strip() in ('gzip', '*'):
+            if len(parts) > 1 and parts[1].strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                return False
+            return True
+    return False
+
+# Written next to the static files by `microweb run`, read by mount_static()
+STATIC_MANIFEST = '.manifest.json'
+
+def load_static_manifest(path):
+    """Read a static manifest into {name: [size, mtime, etag]}; None if absent or unreadable."""
+    try:
+        with open(path) as f:
+            data = ujson.load(f)
+        files = {}
+        for name, info in data['files'].items():
+            files[name] = [info['size'], 0, info.get('etag')]
+        return files
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def scan_static_dir(directory, relative='', files=None):
+    """Walk a directory into {relative name: [size, mtime, None]}, skipping dotfiles."""
+    if files is None:
+        files = {}
+    path = directory + '/' + relative if relative else directory
+    for name in os.listdir(path):
+        if name.startswith('.'):
+            continue
+        rel = relative + '/' + name if relative else name
+        stat = os.stat(path + '/' + name)
+        if stat[0] & 0x4000:  # directory
+            scan_static_dir(directory, rel, files)
+        else:
+            files[rel] = [stat[6], stat[8], None]
+    return files
+
+class LRUCache:
+    """Base of the in-RAM caches: least recently used eviction under a byte
+    budget and, optionally, an entry count.
+    
+    Entries are lists whose last item is the tick they were last used at;
+    subclasses say how many bytes an entry holds via entry_size(). A budget
+    or max_entries of None means no limit of that kind. An entry larger than
+    the budget is refused, or with keep_oversized cached on its own.
+    """
+    keep_oversized = False
+    
+    def __init__(self, budget=None, max_entries=None):
+        self.budget = budget
+        self.max_entries = max_entries
+        self.entries = {}
+        self.used = 0
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def entry_size(self, entry):
+        return 0
+    
+    def touch(self, entry):
+        self.tick += 1
+        entry[-1] = self.tick
+    
+    def lookup(self, key):
+        """Entry for key, counted as a hit and marked used, or None (a miss)."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(entry)
+        return entry
+    
+    def store(self, key, entry):
+        """Add an entry, evicting others to fit; False (nothing stored) if make_room refuses it."""
+        self.remove(key)
+        if not self.make_room(self.entry_size(entry)):
+            return False
+        self.touch(entry)
+        self.entries[key] = entry
+        self.used += self.entry_size(entry)
+        return True
+    
+    def make_room(self, needed):
+        """Evict least recently used entries until `needed` more bytes and one more entry fit."""
+        if self.budget is not None and needed > self.budget:
+            if not self.keep_oversized:
+                return False  # would only empty the cache
+            needed = self.budget
+        while self.entries and ((self.budget is not None and self.used + needed > self.budget) or
+                                (self.max_entries is not None and len(self.entries) >= self.max_entries)):
+            self.remove(self.oldest())
+        return True
+    
+    def oldest(self):
+        oldest = None
+        for key, entry in self.entries.items():
+            if oldest is None or entry[-1] < self.entries[oldest][-1]:
+                oldest = key
+        return oldest
+    
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= self.entry_size(entry)
+        return entry
+    
+    def clear(self):
+        self.entries = {}
+        self.used = 0
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.used, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0}
+
+class StaticFileCache(LRUCache):
+    """LRU cache of small static files, held as prebuilt HTTP responses.
+    
+    Entries are keyed by (file path, Cache-Control) and store the file's
+    mtime, its 200 header block without the Connection line, and its body, so
+    each Connection variant is a single join. Data larger than `budget` is
+    never cached; otherwise the least recently used entries are evicted until
+    it fits, and then while free heap stays below `min_free`.
+    """
+    def __init__(self, budget=16384, max_file_size=4096, min_free=16384):
+        LRUCache.__init__(self, budget)
+        self.max_file_size = max_file_size
+        self.min_free = min_free
+        # entries: key -> [mtime, head, body, last_used]
+    
+    def entry_size(self, entry):
+        return len(entry[1]) + len(entry[2])
+    
+    def get(self, key):
+        return self.lookup(key)
+    
+    def put(self, key, mtime, head, body):
+        """Cache a file's header block and body, making room first; returns the entry either way."""
+        entry = [mtime, head, body, 0]
+        if len(body) <= self.max_file_size:
+            self.store(key, entry)
+        return entry
+    
+    def make_room(self, needed):
+        if not LRUCache.make_room(self, needed):
+            return False
+        mem_free = getattr(gc, 'mem_free', None)
+        if mem_free is not None and mem_free() < self.min_free:
+            # Evicted entries only count once collected, so collect before each further eviction
+            gc.collect()
+            while mem_free() < self.min_free:
+                if not self.entries:
+                    return False
+                self.remove(self.oldest())
+                gc.collect()
+        return True
+
+class ResponseCache(LRUCache):
+    """LRU cache of the serialised responses of @app.cache routes.
+    
+    Entries are keyed by path plus the route's vary values and store the
+    header block without its Connection line plus the body, so a hit is one
+    join, without running the handler or building headers. Entries expire
+    `ttl` seconds after they were stored; responses larger than `budget`
+    are not cached, and the least recently used entries are evicted to fit.
+    """
+    def __init__(self, budget=8192):
+        LRUCache.__init__(self, budget)
+        # entries: key -> [head, body, stored_at, ttl_ms, last_used]
+    
+    def entry_size(self, entry):
+        return len(entry[0]) + len(entry[1])
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[3] is not None and ticks_diff(ticks_ms(), entry[2]) >= entry[3]:
+            self.remove(key)
+        return self.lookup(key)
+    
+    def put(self, key, head, body, ttl):
+        """Cache a route's header block and body, making room first."""
+        self.store(key, [head, body, ticks_ms(), None if ttl is None else int(ttl * 1000), 0])
+
+class CachedResponse:
+    """A route response served from the ResponseCache, or a fresh one to store there once serialised."""
+    def __init__(self, cache, key, entry=None, response=None, ttl=None):
+        self.cache = cache
+        self.key = key
+        self.entry = entry
+        self.response = response
+        self.ttl = ttl
+    
+    def data(self, keep_alive):
+        """Complete response bytes for keep_alive."""
+        if self.entry is not None:
+            return self.entry[0] + HEAD_ENDINGS[keep_alive] + self.entry[1]
+        body = bytes(self.response.body_bytes())
+        head = self.response.header_block(None, len(body))[:-2]
+        self.cache.put(self.key, head, body, self.ttl)
+        return head + HEAD_ENDINGS[keep_alive] + body
+
+# Request values a cached route can vary on: 'query.<name>', 'header.<name>', 'params.<name>'
+VARY_SOURCES = ('query', 'header', 'params')
+
+def route_cache_vary(spec):
+    """Split a vary spec such as 'query.page' into (source, name) once at decoration time."""
+    parts = spec.split('.', 1)
+    if len(parts) != 2 or parts[0] not in VARY_SOURCES:
+        raise ValueError(f'Unsupported vary key: {spec}')
+    source, name = parts
+    return source, name.lower() if source == 'header' else name
+
+def route_cache_key(req, vary):
+    """Cache key of a request: its path, plus the values of the route's vary specs."""
+    if not vary:
+        return req.path
+    key = [req.path]
+    for source, name in vary:
+        if source == 'query':
+            key.append(req.query_params.get(name))
+        elif source == 'header':
+            key.append(req.headers.get(name))
+        else:
+            key.append(req.params.get(name))
+    return tuple(key)
 
 def parse_template(template):
     """Parse HTML template into a node structure optimized for MicroPython."""
@@ -98,7 +1029,9 @@ def parse_template(template):
                 stack[-1].append({'type': 'text', 'content': buffer})
                 buffer = ''
             
-            if tag == 'endfor':
+            if parse_block_tag(tag, stack, line, tag_start):
+                pass
+            elif tag == 'endfor':
                 if len(stack) == 1:
                     raise ValueError(f"Mismatched endfor at line {line}, position {tag_start}")
                 stack.pop()
@@ -127,16 +1060,19 @@ def parse_template(template):
                 if len(parts) != 2:
                     raise ValueError(f"Invalid for syntax at line {line}, position {tag_start}")
                 var, iterable = parts
-                for_node = {'type': 'for', 'var': var.strip(), 'iterable': iterable.strip(), 'body': []}
+                iterable = iterable.strip()
+                for_node = {'type': 'for', 'var': var.strip(), 'iterable': iterable, 'iterable_path': var_path(iterable),
+                            'body': []}
                 stack[-1].append(for_node)
                 stack.append(for_node['body'])
             elif tag.startswith('if '):
                 condition = tag[3:].strip()
-                if_node = {'type': 'if', 'condition': condition, 'then_branch': [], 'else_branch': None}
+                if_node = {'type': 'if', 'condition': condition, 'condition_path': var_path(condition),
+                           'then_branch': [], 'else_branch': None}
                 stack[-1].append(if_node)
                 stack.append(if_node['then_branch'])
             else:
-                stack[-1].append({'type': 'var', 'name': tag})
+                stack[-1].append(var_node(tag, line, tag_start))
             pos = close_pos + 2
         else:
             close_pos = template.find('%}', tag_start + 2)
@@ -149,7 +1085,8 @@ def parse_template(template):
                 stack[-1].append({'type': 'text', 'content': buffer})
                 buffer = ''
             
-            stack[-1].append({'type': 'var', 'name': tag})
+            if not parse_block_tag(tag, stack, line, tag_start):
+                stack[-1].append(var_node(tag, line, tag_start))
             pos = close_pos + 2
     
     if len(stack) > 1:
@@ -161,53 +1098,672 @@ def parse_template(template):
     
     return nodes
 
-def get_var(context, var_name):
-    """Resolve variable names with dot notation (e.g., project.title)."""
-    parts = var_name.split('.')
-    value = context
-    for part in parts:
+def var_node(tag, line, position):
+    """Node for a variable substitution; output is HTML-escaped unless the tag ends in |safe."""
+    parts = tag.split('|')
+    name = parts[0].strip()
+    autoescape = True
+    for filter_name in parts[1:]:
+        if filter_name.strip() != 'safe':
+            raise ValueError(f"Unknown filter {filter_name.strip()} at line {line}, position {position}")
+        autoescape = False
+    return {'type': 'var', 'name': name, 'path': var_path(name), 'escape': autoescape}
+
+def parse_block_tag(tag, stack, line, position):
+    """Add an include, extends, block or cache tag to the node stack; False for any other tag."""
+    parts = tag.split()
+    keyword = parts[0] if parts else ''
+    if keyword in ('include', 'extends') and len(parts) == 2:
+        if keyword == 'extends' and len(stack) > 1:
+            raise ValueError(f"extends must be at the top level, line {line}, position {position}")
+        stack[-1].append({'type': keyword, 'name': parts[1].strip('\'"')})
+    elif keyword == 'block' and len(parts) == 2:
+        name = parts[1]
+        for char in name:
+            if not (char.isalpha() or char.isdigit() or char == '_'):
+                raise ValueError(f"Invalid block name at line {line}, position {position}")
+        block_node = {'type': 'block', 'name': name, 'body': []}
+        stack[-1].append(block_node)
+        stack.append(block_node['body'])
+    elif keyword == 'cache' and len(parts) >= 2:
+        # {% cache key [ttl] [var ...] %}: the vars' values become part of the key
+        ttl = None
+        vary = parts[2:]
+        if vary and vary[0].isdigit():
+            ttl = int(vary[0])
+            vary = vary[1:]
+        cache_node = {'type': 'cache', 'key': parts[1].strip('\'"'), 'ttl': ttl, 'vary': vary,
+                      'vary_paths': [var_path(var) for var in vary], 'body': []}
+        stack[-1].append(cache_node)
+        stack.append(cache_node['body'])
+    elif keyword in ('endblock', 'endcache'):
+        if len(stack) == 1:
+            raise ValueError(f"Mismatched {keyword} at line {line}, position {position}")
+        stack.pop()
+    else:
+        return False
+    return True
+
+def var_path(var_name):
+    """Split a dotted variable name once, at parse time: ('items', 0, 'title') for items.0.title.
+    
+    Name segments are looked up as dict keys or attributes, numeric ones as
+    sequence indexes.
+    """
+    return tuple([int(part) if part.isdigit() else part for part in var_name.split('.')])
+
+def lookup(value, path):
+    """Resolve a var_path tuple against value; '' when any segment is missing."""
+    for part in path:
         if isinstance(value, dict):
-            value = value.get(part, '')
-        elif hasattr(value, part):
-            value = getattr(value, part)
+            value = value.get(part if isinstance(part, str) else str(part), '')
+        elif isinstance(part, int):
+            try:
+                value = value[part]
+            except (IndexError, KeyError, TypeError):
+                return ''
         else:
-            return ''
+            try:
+                value = getattr(value, part)
+            except AttributeError:
+                return ''
     return value
 
-def render_nodes(nodes, context):
-    output = []
+# Characters escaped in template output, and their entities
+HTML_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'), ("'", '&#39;'))
+
+def escape(value):
+    """HTML-escape a value for template output.
     
+    Numbers are only converted, and a string without any of &<>"' is
+    returned as-is, so plain text costs a scan and no copy.
+    """
+    if isinstance(value, (int, float)):
+        return str(value)
+    if not isinstance(value, str):
+        value = str(value)
+    if '&' in value or '<' in value or '>' in value or '"' in value or "'" in value:
+        for char, entity in HTML_ESCAPES:
+            value = value.replace(char, entity)
+    return value
+
+def get_var(context, var_name):
+    """Resolve variable names with dot notation (e.g., project.title)."""
+    return lookup(context, var_path(var_name))
+
+# A compiled template yields its output list once it holds this many pieces
+TEMPLATE_FLUSH = 64
+
+def template_source(nodes):
+    """Generate Python source for a parsed node tree.
+    
+    The source defines render(context, template), a generator that appends
+    every piece of output to a single list, with no per-node type dispatch or
+    recursion, and yields the joined list after a top-level node or loop
+    iteration once it holds TEMPLATE_FLUSH pieces, so a streamed page never
+    holds more than one fragment. Each block and cached fragment becomes a
+    generator of its own; BLOCKS maps block names to them and PARENT names
+    the template this one extends, whose render is used in place of its own.
+    Dotted variable paths become module-level tuples (P0, P1, ...) built once
+    at import, so a render allocates nothing to look a variable up.
+    """
+    parent = None
     for node in nodes:
-        if node['type'] == 'text':
-            output.append(node['content'])
-        elif node['type'] == 'var':
-            value = get_var(context, node['name'])
-            output.append(str(value))
-        elif node['type'] == 'if':
-            condition_value = get_var(context, node['condition'])
-            if condition_value and condition_value != '' and condition_value != []:
-                output.append(render_nodes(node['then_branch'], context))
-            elif node['else_branch'] is not None:
-                output.append(render_nodes(node['else_branch'], context))
-        elif node['type'] == 'for':
-            iterable = get_var(context, node['iterable'])
-            if isinstance(iterable, list):
-                for item in iterable:
-                    loop_context = context.copy()
-                    loop_context[node['var']] = item
-                    output.append(render_nodes(node['body'], loop_context))
-    
-    return ''.join(output)
+        if node['type'] == 'extends':
+            parent = node['name']
+    # Emitting a function may queue blocks and fragments and register paths
+    unit = {'functions': [('render', nodes)], 'paths': {}}
+    functions = unit['functions']
+    lines = []
+    index = 0
+    while index < len(functions):
+        name, body = functions[index]
+        if name == 'render' and parent is not None:
+            emit_function(name, body, [], unit)  # only its blocks are used
+            lines.append('render = None')
+        else:
+            emit_function(name, body, lines, unit)
+        index += 1
+    constants = [name + ' = ' + repr(path) for path, name in unit['paths'].items()]
+    blocks = [name[6:] for name, body in functions if name.startswith('block_')]
+    lines.append('BLOCKS = {' + ', '.join([repr(name) + ': block_' + name for name in blocks]) + '}')
+    lines.append('PARENT = ' + repr(parent))
+    return '\n'.join(constants + lines)
+
+def emit_function(name, nodes, lines, unit):
+    lines.append('def ' + name + '(c0, t):')
+    lines.append(' o = []')
+    lines.append(' a = o.append')
+    emit_nodes(nodes, lines, 1, [], unit)
+    lines.append(' if o:')
+    lines.append("  yield ''.join(o)")
+
+def emit_flush(lines, pad):
+    lines.append(pad + 'if len(o) >= ' + str(TEMPLATE_FLUSH) + ':')
+    lines.append(pad + " yield ''.join(o)")
+    lines.append(pad + ' del o[:]')
+
+def emit_pending(lines, pad):
+    lines.append(pad + 'if o:')
+    lines.append(pad + " yield ''.join(o)")
+    lines.append(pad + ' del o[:]')
+
+# loop.<name> inside a for: expression over the loop's counter nN or last flag zN
+LOOP_VARS = {'index': 'n{}', 'index0': '(n{} - 1)', 'first': '(n{} == 1)', 'last': 'z{}'}
+
+def emit_lookup(path, frames, unit):
+    """Expression resolving a var_path tuple.
+    
+    Loop variables of the enclosing fors are locals (vN) and loop.* reads
+    the innermost loop's counters; any other name is a plain get on the
+    context c0, with lookup() following the rest of a dotted path.
+    """
+    head = None
+    rest = path[1:]
+    for i in range(len(frames) - 1, -1, -1):
+        if frames[i]['var'] == path[0]:
+            head = 'v' + frames[i]['n']
+            break
+    if head is None and path[0] == 'loop' and frames:
+        frame = frames[-1]
+        if not rest or rest[0] not in LOOP_VARS:
+            return "''"
+        frame['last' if rest[0] == 'last' else 'count'] = True
+        head = LOOP_VARS[rest[0]].format(frame['n'])
+        rest = rest[1:]
+    if head is None:
+        if isinstance(path[0], str):
+            head = 'c0.get(' + repr(path[0]) + ", '')"
+        else:
+            head = 'c0'
+            rest = path
+    if not rest:
+        return head
+    name = unit['paths'].get(rest)
+    if name is None:
+        name = 'P' + str(len(unit['paths']))
+        unit['paths'][rest] = name
+    return 'lookup(' + head + ', ' + name + ')'
+
+def is_loop_var(path, frames):
+    """True when path is loop.index/index0/first/last of an enclosing for."""
+    if len(path) != 2 or path[0] != 'loop' or path[1] not in LOOP_VARS or not frames:
+        return False
+    for frame in frames:
+        if frame['var'] == 'loop':
+            return False
+    return True
+
+def emit_context(frames):
+    """The context to hand to a block, include or cached fragment: the innermost loop's Scope."""
+    if not frames:
+        return 'c0'
+    for frame in frames:
+        frame['scope'] = True  # each Scope's parent is the enclosing loop's
+    return 's' + frames[-1]['n']
+
+def emit_nodes(nodes, lines, indent, frames, unit):
+    """Append source for nodes to lines; frames describe the enclosing for loops, t is the template."""
+    functions = unit['functions']
+    pad = ' ' * indent
+    start = len(lines)
+    text = ''
+    for node in nodes:
+        node_type = node['type']
+        if node_type == 'text':
+            text += node['content']  # adjacent text becomes a single append
+            continue
+        if node_type == 'extends':
+            continue
+        if text:
+            lines.append(pad + 'a(' + repr(text) + ')')
+            text = ''
+        if not frames and indent == 1 and len(lines) > start:
+            emit_flush(lines, pad)  # between top-level nodes
+        if node_type == 'var':
+            # loop.* values are numbers or booleans, which never need escaping
+            convert = 'escape(' if node['escape'] and not is_loop_var(node['path'], frames) else 'str('
+            lines.append(pad + 'a(' + convert + emit_lookup(node['path'], frames, unit) + '))')
+        elif node_type == 'if':
+            lines.append(pad + 'if ' + emit_lookup(node['condition_path'], frames, unit) + ':')
+            emit_nodes(node['then_branch'], lines, indent + 1, frames, unit)
+            if node['else_branch'] is not None:
+                lines.append(pad + 'else:')
+                emit_nodes(node['else_branch'], lines, indent + 1, frames, unit)
+        elif node_type == 'for':
+            emit_for(node, lines, pad, frames, unit)
+        elif node_type == 'block':
+            name = 'block_' + node['name']
+            for queued, body in functions:
+                if queued == name:
+                    raise ValueError(f"Duplicate block {node['name']}")
+            functions.append((name, node['body']))
+            emit_pending(lines, pad)  # keep output in order around the block's fragments
+            lines.append(pad + 'yield from t.block(' + repr(node['name']) + ', ' + emit_context(frames) + ')')
+        elif node_type == 'include':
+            emit_pending(lines, pad)
+            lines.append(pad + 'yield from t.include(' + repr(node['name']) + ', ' + emit_context(frames) + ')')
+        elif node_type == 'cache':
+            name = 'fragment_' + str(len(functions))
+            functions.append((name, node['body']))
+            key = repr(node['key'])
+            if node['vary_paths']:
+                key = '(' + key + ''.join([', ' + emit_lookup(path, frames, unit) for path in node['vary_paths']]) + ')'
+            lines.append(pad + 'a(t.cached(' + key + ', ' + repr(node['ttl']) + ', ' + name + ', ' +
+                         emit_context(frames) + '))')
+    if text:
+        lines.append(pad + 'a(' + repr(text) + ')')
+    if len(lines) == start:
+        lines.append(pad + 'pass')
+
+def emit_for(node, lines, pad, frames, unit):
+    """Append a for loop over any iterable.
+    
+    The loop variable is the local vN, so an iteration copies no context.
+    The body is generated first; what it used decides the rest: a counter
+    nN for loop.index/first, one item of lookahead into uN for loop.last,
+    and a single reused Scope sN when a block, include or cached fragment
+    needs the loop variable in a context.
+    """
+    n = str(len(frames) + 1)
+    frame = {'var': node['var'], 'n': n, 'count': False, 'last': False, 'scope': False}
+    body = []
+    emit_nodes(node['body'], body, len(pad) + 1, frames + [frame], unit)
+    lines.append(pad + 'i' + n + ' = loop_iter(' + emit_lookup(node['iterable_path'], frames, unit) + ')')
+    if frame['scope']:
+        parent = 's' + frames[-1]['n'] if frames else 'c0'
+        lines.append(pad + 's' + n + ' = Scope(' + parent + ', ' + repr(node['var']) + ')')
+    if frame['count']:
+        lines.append(pad + 'n' + n + ' = 0')
+    if frame['last']:
+        lines.append(pad + 'z' + n + ' = False')
+        lines.append(pad + 'try:')
+        lines.append(pad + ' u' + n + ' = next(i' + n + ')')
+        lines.append(pad + 'except StopIteration:')
+        lines.append(pad + ' z' + n + ' = True')
+        lines.append(pad + 'while not z' + n + ':')
+        lines.append(pad + ' v' + n + ' = u' + n)
+        lines.append(pad + ' try:')
+        lines.append(pad + '  u' + n + ' = next(i' + n + ')')
+        lines.append(pad + ' except StopIteration:')
+        lines.append(pad + '  z' + n + ' = True')
+    else:
+        lines.append(pad + 'for v' + n + ' in i' + n + ':')
+    if frame['count']:
+        lines.append(pad + ' n' + n + ' += 1')
+    if frame['scope']:
+        lines.append(pad + ' s' + n + '.value = v' + n)
+    lines.extend(body)
+    emit_flush(lines, pad + ' ')
+
+def loop_iter(value):
+    """Iterator for a template for loop; empty when the value cannot be iterated (e.g. a missing variable)."""
+    try:
+        return iter(value)
+    except TypeError:
+        return iter(())
+
+class Scope:
+    """Template context of a loop body: the loop variable over the enclosing context.
+    
+    One Scope is made per loop and its value updated each iteration, so
+    blocks, includes and cached fragments inside a loop see the loop variable
+    without the context being copied.
+    """
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+        self.value = ''
+    
+    def get(self, name, default=None):
+        if name == self.name:
+            return self.value
+        return self.parent.get(name, default)
+
+# Names the generated render functions use, provided to exec() or imported by precompiled modules
+TEMPLATE_GLOBALS = {'get_var': get_var, 'lookup': lookup, 'loop_iter': loop_iter, 'Scope': Scope, 'escape': escape}
+# Version of the generated code; precompiled modules of any other version are ignored
+TEMPLATE_FORMAT = 4
+
+class Template:
+    """A compiled template.
+    
+    function(context, template) is the generated generator for the page and
+    blocks maps block names to generated block functions. A template that
+    extends `parent` renders the parent's page with its own blocks in place
+    of the parent's. `loader` (template name -> Template) resolves include
+    and extends and `fragments` stores {% cache %} output; the app sets both
+    on the templates it loads, so included and extended templates are
+    compiled once and shared by every template that uses them.
+    """
+    def __init__(self, function, blocks=None, parent=None):
+        self.function = function
+        self.own_blocks = blocks or {}
+        self.blocks = self.own_blocks  # own blocks merged over the parent's
+        self.parent = parent
+        self.parent_blocks = None
+        self.loader = None
+        self.fragments = None
+    
+    def load(self, template_file):
+        if self.loader is None:
+            raise ValueError(f'No loader for {template_file}')
+        return self.loader(template_file)
+    
+    def resolve(self):
+        """(page function, block table) after following extends."""
+        if self.parent is None:
+            return self.function, self.blocks
+        function, blocks = self.load(self.parent).resolve()
+        if blocks is not self.parent_blocks:  # first use, or the parent was reloaded
+            merged = dict(blocks)
+            merged.update(self.own_blocks)
+            self.blocks = merged
+            self.parent_blocks = blocks
+        return function, self.blocks
+    
+    def stream(self, context):
+        """Generator of the rendered output in fragments."""
+        return self.resolve()[0](context, self)
+    
+    def render(self, context):
+        return ''.join(self.stream(context))
+    
+    def block(self, name, context):
+        return self.blocks[name](context, self)
+    
+    def include(self, template_file, context):
+        return self.load(template_file).stream(context)
+    
+    def cached(self, key, ttl, fragment, context):
+        """Output of a {% cache %} fragment, rendered only when not cached or expired."""
+        if self.fragments is None:
+            return ''.join(fragment(context, self))
+        text = self.fragments.get_fragment(key)
+        if text is None:
+            text = ''.join(fragment(context, self))
+            self.fragments.put_fragment(key, text, ttl)
+        return text
+
+def compile_template(template):
+    """Parse template text and compile it into a Template."""
+    return compile_nodes(parse_template(template))
+
+def compile_nodes(nodes):
+    """Compile a parsed node tree into a Template."""
+    namespace = dict(TEMPLATE_GLOBALS)
+    exec(template_source(nodes), namespace)
+    return Template(namespace['render'], namespace['BLOCKS'], namespace['PARENT'])
+
+def render_nodes(nodes, context):
+    """Render a parsed node tree once; kept for callers of the old interpreter, compile_template is faster."""
+    return compile_nodes(nodes).render(context)
+
+class TemplateCache(LRUCache):
+    """LRU cache of compiled templates keyed by template file.
+    
+    Holds at most `max_entries` templates and, as far as it can tell from
+    their source sizes, `max_bytes` of templates; the least recently used are
+    evicted first (a single larger template is still kept on its own). With
+    `check_interval` set, a cached file's size and mtime are re-checked at most
+    once per that many seconds and a changed file is dropped for recompiling.
+    It also holds the rendered output of up to `max_fragments` {% cache %}
+    fragments, each until its ttl (seconds, None for no limit) runs out.
+    Removing a template also drops its precompiled module from sys.modules,
+    so the next load imports it afresh.
+    """
+    keep_oversized = True
+    
+    def __init__(self, max_entries=8, max_bytes=32768, check_interval=None, max_fragments=16):
+        LRUCache.__init__(self, max_bytes, max_entries)
+        self.check_interval = check_interval
+        # entries: template_file -> [template, size, mtime, last_checked, last_used]
+        self.fragments = LRUCache(None, max_fragments)  # key -> [text, stored_at, ttl_ms, last_used]
+    
+    def entry_size(self, entry):
+        return entry[1]
+    
+    def get(self, template_file):
+        entry = self.entries.get(template_file)
+        if entry is not None and self.check_interval is not None:
+            now = ticks_ms()
+            if ticks_diff(now, entry[3]) >= self.check_interval * 1000:
+                entry[3] = now
+                if file_signature(template_file) not in ((entry[1], entry[2]), None):
+                    self.remove(template_file)
+        entry = self.lookup(template_file)
+        return None if entry is None else entry[0]
+    
+    def put(self, template_file, template):
+        signature = file_signature(template_file) or (0, 0)
+        self.store(template_file, [template, signature[0], signature[1], ticks_ms(), 0])
+    
+    def remove(self, template_file):
+        entry = LRUCache.remove(self, template_file)
+        if entry is not None:
+            unload_precompiled(template_file)
+        return entry
+    
+    def get_fragment(self, key):
+        entry = self.fragments.entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] is not None and ticks_diff(ticks_ms(), entry[1]) >= entry[2]:
+            self.fragments.remove(key)
+            return None
+        self.fragments.touch(entry)
+        return entry[0]
+    
+    def put_fragment(self, key, text, ttl):
+        if self.fragments.max_entries > 0:
+            self.fragments.store(key, [text, ticks_ms(), None if ttl is None else ttl * 1000, 0])
+    
+    def clear(self):
+        for template_file in self.entries:
+            unload_precompiled(template_file)
+        LRUCache.clear(self)
+        self.fragments.clear()
+    
+    def stats(self):
+        stats = LRUCache.stats(self)
+        stats['fragments'] = len(self.fragments.entries)
+        return stats
+
+def file_signature(path):
+    """(size, mtime) of a file, or None if it cannot be stat'ed."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat[6], stat[8]
+
+def precompiled_name(template_file):
+    """Module name of a template's precompiled form, from its path as rendered or included:
+    index.html -> tpl_index_html, parts/nav.html -> tpl_parts_nav_html."""
+    name = template_file.replace('\\', '/')
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.lstrip('/')
+    return 'tpl_' + ''.join([char if char.isalpha() or char.isdigit() else '_' for char in name])
+
+def file_digest(path):
+    """SHA-256 digest of a file, read in small chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(512)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+def unload_precompiled(template_file):
+    """Forget a template's precompiled module, if imported, so a new upload is picked up."""
+    sys.modules.pop(precompiled_name(template_file), None)
+
+def template_module_source(template, template_file):
+    """Source of the module `microweb run` uploads for a template, so the device skips parsing it.
+    
+    `template` must be the file's text without newline translation (open with
+    newline=''), so SOURCE_SIZE and SOURCE_HASH match the file on the device.
+    """
+    return ('# Precompiled from ' + template_file + ' by microweb run; regenerate rather than edit.\n'
+            'from microweb import ' + ', '.join(TEMPLATE_GLOBALS) + '\n'
+            'FORMAT = ' + str(TEMPLATE_FORMAT) + '\n'
+            'SOURCE_SIZE = ' + str(len(template.encode('utf-8'))) + '\n'
+            'SOURCE_HASH = ' + repr(hashlib.sha256(template.encode('utf-8')).digest()) + '\n'
+            + template_source(parse_template(template)) + '\n')
+
+# Route parameter converters: <name>, <int:name>, <path:name>
+ROUTE_CONVERTERS = {
+    'str': ('[^/]+', None),
+    'int': ('-?[0-9]+', int),
+    'path': ('.+', None),
+}
+
+REGEX_CHARS = '.^$*+?{}[]\\|()'
+
+def regex_literal(text):
+    """Escape text so it matches itself inside a regex (ure has no re.escape)."""
+    return ''.join(['\\' + char if char in REGEX_CHARS else char for char in text])
+
+def compile_route(route_pattern):
+    """Compile a route pattern once into (regex, params).
+    
+    params lists (name, converter) for each capture group; the text between
+    parameters matches literally. Returns None for paths without a <param>,
+    which are dispatched from the exact-match table instead.
+    """
+    if '<' not in route_pattern:
+        return None
+    regex_pattern = '^'
+    params = []
+    pos = 0
+    while True:
+        start = route_pattern.find('<', pos)
+        end = route_pattern.find('>', start)
+        if start == -1 or end == -1:
+            regex_pattern += regex_literal(route_pattern[pos:])
+            break
+        regex_pattern += regex_literal(route_pattern[pos:start])
+        spec = route_pattern[start + 1:end]
+        converter_name, name = spec.split(':', 1) if ':' in spec else ('str', spec)
+        if converter_name not in ROUTE_CONVERTERS:
+            raise ValueError(f"Unknown route converter '{converter_name}' in {route_pattern}")
+        group_pattern, converter = ROUTE_CONVERTERS[converter_name]
+        regex_pattern += '(' + group_pattern + ')'
+        params.append((name, converter))
+        pos = end + 1
+    return ure.compile(regex_pattern + '$'), params
+
+def route_bucket(path):
+    """First path segment, used to narrow down which parameterised routes to try."""
+    end = path.find('/', 1)
+    return path[1:end] if end != -1 else path[1:]
+
+class GCPolicy:
+    """Decides when the server runs gc.collect(), instead of after every connection.
+    
+    A collection runs once free heap drops below `min_free` bytes, after
+    `every` requests (0 disables), or when the server has been idle for
+    `idle_timeout` seconds with requests served since the last one (None
+    disables). `threshold`, when set, is passed to gc.threshold() so the
+    MicroPython heap also collects on its own after that many bytes are
+    allocated. Collection count and time are kept for stats().
+    """
+    def __init__(self, min_free=24576, every=16, idle_timeout=1.0, threshold=None):
+        self.min_free = min_free
+        self.every = every
+        self.idle_timeout = idle_timeout
+        self.threshold = threshold
+        self.pending = 0  # requests served since the last collection
+        self.last_activity = ticks_ms()
+        self.collections = 0
+        self.total_ms = 0
+        self.max_ms = 0
+        if threshold is not None and hasattr(gc, 'threshold'):
+            gc.threshold(threshold)
+    
+    def after_requests(self, count):
+        """Record requests served on a finished connection and collect if a trigger fired."""
+        self.pending += count
+        self.last_activity = ticks_ms()
+        mem_free = getattr(gc, 'mem_free', None)
+        if (self.every and self.pending >= self.every) or (mem_free is not None and mem_free() < self.min_free):
+            self.collect()
+    
+    def idle(self):
+        """Called when the server has had nothing to do; collects if there is fresh garbage."""
+        if self.pending:
+            self.collect()
+    
+    def collect(self):
+        start = ticks_ms()
+        gc.collect()
+        elapsed = ticks_diff(ticks_ms(), start)
+        self.collections += 1
+        self.total_ms += elapsed
+        if elapsed > self.max_ms:
+            self.max_ms = elapsed
+        self.pending = 0
+    
+    def stats(self):
+        mem_free = getattr(gc, 'mem_free', None)
+        return {'collections': self.collections, 'total_ms': self.total_ms, 'max_ms': self.max_ms,
+                'avg_ms': self.total_ms / self.collections if self.collections else 0,
+                'pending_requests': self.pending, 'mem_free': mem_free() if mem_free else None}
+
+def is_awaitable(obj):
+    """True for coroutines (async def results); MicroPython exposes them as generators."""
+    return hasattr(obj, 'send') and hasattr(obj, 'throw')
 
     
 class MicroWeb:
-    def __init__(self, ssid=None, password=None, port=80, debug=False, ap=None, mode="ap"):
+    def __init__(self, ssid=None, password=None, port=80, debug=False, ap=None, mode="ap",
+                 keep_alive=True, keep_alive_timeout=2.0, keep_alive_max=10, max_header_size=2048,
+                 max_body_size=16384, upload_dir='uploads', static_cache_control='public, max-age=20',
+                 static_cache_size=0, static_cache_max_file=4096, gc_policy=None,
+                 max_connections=8, min_free_memory=8192, retry_after=1,
+                 template_cache_size=8, template_cache_bytes=32768, template_check_interval=None,
+                 fragment_cache_size=16, route_cache_size=8192):
         self.routes = {}
+        self._exact_routes = {}    # path -> route config, O(1) dispatch
+        self._pattern_routes = {}  # first path segment (or None) -> [(path, regex, params, config)]
         self.static_files = {}
         self.lib_files = []  # Added to store library files
-        self.config = {'port': port, 'debug': debug}
+        self.config = {'port': port, 'debug': debug, 'keep_alive': keep_alive,
+                       'keep_alive_timeout': keep_alive_timeout, 'keep_alive_max': keep_alive_max,
+                       'max_header_size': max_header_size, 'max_body_size': max_body_size,
+                       'upload_dir': upload_dir, 'static_cache_control': static_cache_control,
+                       'static_cache_size': static_cache_size, 'static_cache_max_file': static_cache_max_file,
+                       'max_connections': max_connections, 'min_free_memory': min_free_memory,
+                       'retry_after': retry_after, 'template_cache_size': template_cache_size,
+                       'template_cache_bytes': template_cache_bytes,
+                       'template_check_interval': template_check_interval,
+                       'fragment_cache_size': fragment_cache_size, 'route_cache_size': route_cache_size}
         self.session = {}
-        self._template_cache = {}
+        # Compiled templates and {% cache %} fragments, LRU-bounded; template_check_interval
+        # (seconds) enables mtime reloads
+        self._template_cache = TemplateCache(template_cache_size, template_cache_bytes, template_check_interval,
+                                             fragment_cache_size)
+        self._file_buffer = None  # reused by the blocking server to send static files
+        # Serialised responses of @app.cache routes, LRU within route_cache_size bytes
+        self._route_cache = ResponseCache(route_cache_size)
+        self._cache_rules = {}  # handler -> (ttl, [(vary source, name)])
+        self._static_gzip = {}  # static path -> precompressed .gz variant
+        self._static_cache_control = {}  # static path -> Cache-Control overriding the default
+        self._static_index = {}  # URL path -> (content_type, cache_control, plain, gzipped) from mount_static
+        # Optional in-RAM cache of small static files (static_cache_size bytes; 0 disables it)
+        self._static_cache = None
+        if static_cache_size:
+            self._static_cache = StaticFileCache(static_cache_size, static_cache_max_file)
+        self.gc_policy = gc_policy if gc_policy is not None else GCPolicy()
+        # Load shedding: connections over budget get this 503 without their request being read
+        self.active_connections = 0
+        self.shed_count = 0
+        self._shed_response = (STATUS_LINES[503] + f'Retry-After: {retry_after}\r\n'
+                               'Content-Length: 0\r\n' + CONNECTION_CLOSE + '\r\n').encode('utf-8')
+        self._shed_buffer = bytearray(256)
 
         ip = None
 
@@ -215,7 +1771,10 @@ class MicroWeb:
             ssid = ap.get('ssid', 'ESP32-MicroWeb')
             password = ap.get('password', '12345678')
 
-        if mode == "wifi":
+        if wifi is None:
+            # No network module (e.g. running under CPython): serve on all interfaces.
+            ip = '0.0.0.0'
+        elif mode == "wifi":
             ip = wifi.connect_wifi(ssid, password)
             if not ip:
                 print("[Fallback] Failed to connect to WiFi. Starting Access Point instead.")
@@ -249,23 +1808,175 @@ class MicroWeb:
 
     def route(self, path, methods=['GET']):
         def decorator(func):
-            self.routes[path] = {'func': func, 'methods': methods}
+            route_config = {'func': func, 'methods': methods}
+            self.routes[path] = route_config
+            self.compile_route_table(path, route_config)
+            return func
+        return decorator
+    
+    def cache(self, ttl=5, vary=None):
+        """Serve a route's GET responses from memory for `ttl` seconds (None: until cleared).
+        
+        Hits are written from the stored response bytes without calling the
+        handler. `vary` lists request values that get separate copies, as
+        'query.<name>', 'header.<name>' or 'params.<name>'; the path always
+        does. Only 200 responses with a complete body are cached:
+        
+        @app.route('/status')
+        @app.cache(ttl=5, vary=['query.page'])
+        def status(req): ...
+        """
+        rule = (ttl, [route_cache_vary(spec) for spec in vary or ()])
+        def decorator(func):
+            self._cache_rules[func] = rule
             return func
         return decorator
     
-    def add_static(self, path, file_path):
+    def clear_route_cache(self):
+        """Drop all cached route responses, e.g. after the data behind them changed."""
+        self._route_cache.clear()
+    
+    def route_cache_stats(self):
+        """Entry count, bytes and hit/miss counters of the route response cache."""
+        return self._route_cache.stats()
+    
+    def compile_route_table(self, path, route_config):
+        """Index a route once at registration: exact paths in a dict, patterns per first segment."""
+        for bucket in self._pattern_routes.values():
+            for i in range(len(bucket)):
+                if bucket[i][0] == path:
+                    del bucket[i]
+                    break
+        
+        if '<' not in path:
+            self._exact_routes[path] = route_config
+        
+        compiled = compile_route(path)
+        if compiled is None:
+            return
+        
+        regex, params = compiled
+        bucket = route_bucket(path)
+        if '<' in bucket:
+            bucket = None  # first segment is itself dynamic
+        self._pattern_routes.setdefault(bucket, []).append((path, regex, params, route_config))
+    
+    def find_route(self, path):
+        """Return (route_config, match, params) for path, or (None, None, None)."""
+        route_config = self._exact_routes.get(path)
+        if route_config is not None:
+            return route_config, None, None
+        
+        for bucket in (route_bucket(path), None):
+            for route_path, regex, params, route_config in self._pattern_routes.get(bucket, ()):
+                match = regex.match(path)
+                if match:
+                    return route_config, match, params
+        return None, None, None
+    
+    def add_static(self, path, file_path, cache_control=None):
         self.static_files[path] = file_path
+        if cache_control is None:
+            self._static_cache_control.pop(path, None)
+        else:
+            self._static_cache_control[path] = cache_control
+        # Look once for a precompressed sibling (style.css -> style.css.gz)
+        try:
+            os.stat(file_path + '.gz')
+            self._static_gzip[path] = file_path + '.gz'
+        except OSError:
+            self._static_gzip.pop(path, None)
+    
+    def mount_static(self, url_prefix, directory, cache_control=None, manifest=STATIC_MANIFEST):
+        """Serve every file under `directory` at url_prefix + '/' + its relative path.
+        
+        The directory is indexed once, here: sizes, content types, .gz variants
+        and prebuilt 200 header blocks, so serving a file is a single dict
+        lookup with no stat. A manifest written by `microweb run` (see
+        STATIC_MANIFEST) replaces the directory walk when present; pass
+        manifest=None to always walk. Mount again after changing the files.
+        """
+        if cache_control is None:
+            cache_control = self.config['static_cache_control']
+        directory = directory.rstrip('/')
+        files = load_static_manifest(directory + '/' + manifest) if manifest else None
+        if files is None:
+            files = scan_static_dir(directory)
+        
+        prefix = url_prefix.rstrip('/')
+        for name, info in files.items():
+            if name.endswith('.gz') and name[:-3] in files:
+                continue  # precompressed variant, indexed with its original
+            content_type = self.get_content_type(name)
+            gzip_info = files.get(name + '.gz')
+            vary = gzip_info is not None
+            plain = self.static_variant(directory + '/' + name, info, content_type, None, vary, cache_control)
+            gzipped = None
+            if vary:
+                gzipped = self.static_variant(directory + '/' + name + '.gz', gzip_info, content_type,
+                                              'gzip', vary, cache_control)
+            self._static_index[prefix + '/' + name] = (content_type, cache_control, plain, gzipped)
+        
+        if self.config['debug']:
+            print(f'Mounted {len(files)} static files from {directory} at {prefix}/')
+    
+    def static_variant(self, file_path, info, content_type, content_encoding, vary, cache_control):
+        """Index entry for one file: (file_path, size, mtime, etag, prebuilt 200 header block)."""
+        size, mtime, etag = info
+        response = FileResponse(file_path, content_type, content_encoding, vary, cache_control)
+        response.etag = etag
+        head = self.file_headers(response, size, mtime, None, False)[0][:-2]
+        return (file_path, size, mtime, etag, head)
+    
+    def load_template(self, template_file):
+        """Return the compiled Template for a template file, loading it on first use.
+        
+        A precompiled module uploaded by `microweb run` is used when present
+        and still matches the template; otherwise the template is parsed and
+        compiled here.
+        """
+        template = self._template_cache.get(template_file)
+        if template is None:
+            template = self.load_precompiled_template(template_file)
+            if template is None:
+                with open(template_file, 'r') as f:
+                    template = compile_template(f.read())
+            template.loader = self.load_template
+            template.fragments = self._template_cache
+            self._template_cache.put(template_file, template)
+        return template
+    
+    def clear_template_cache(self):
+        """Forget all compiled templates and cached fragments; templates are reloaded on their next render."""
+        self._template_cache.clear()
+    
+    def template_cache_stats(self):
+        """Entry count, approximate bytes and hit/miss counters of the template cache."""
+        return self._template_cache.stats()
+    
+    def load_precompiled_template(self, template_file):
+        """Template from the precompiled module for template_file, or None if missing or stale."""
+        try:
+            module = __import__(precompiled_name(template_file))
+        except ImportError:
+            return None
+        if getattr(module, 'FORMAT', None) != TEMPLATE_FORMAT:
+            unload_precompiled(template_file)
+            return None  # precompiled by another microweb version
+        try:
+            # Size first, as it needs no read; the hash catches same-size edits
+            if os.stat(template_file)[6] != module.SOURCE_SIZE or file_digest(template_file) != module.SOURCE_HASH:
+                unload_precompiled(template_file)
+                return None  # the template changed after it was precompiled
+        except OSError:
+            pass  # only the precompiled form is on the device
+        if self.config['debug']:
+            print(f'Loaded precompiled template: {template_file}')
+        return Template(module.render, module.BLOCKS, module.PARENT)
     
     def render_template(self, template_file, **kwargs):
         try:
-            cache_key = template_file
-            if cache_key not in self._template_cache:
-                with open(template_file, 'r') as f:
-                    template = f.read()
-                self._template_cache[cache_key] = parse_template(template)
-            
-            nodes = self._template_cache[cache_key]
-            content = render_nodes(nodes, kwargs)
+            content = self.load_template(template_file).render(kwargs)
             
             if self.config['debug']:
                 print(f'Rendered template: {template_file} ({len(content)} chars)')
@@ -277,6 +1988,21 @@ class MicroWeb:
                 print(f'Template error: {e}')
             return f'<h1>Template Error</h1><p>Error in {template_file}: {str(e)}</p>'
     
+    def render_template_stream(self, template_file, **kwargs):
+        """Render a template as a generator of fragments, produced as the page is rendered.
+        
+        Wrap it in a Response to send the page with chunked transfer encoding,
+        so only one fragment is in memory at a time:
+        return Response(app.render_template_stream('log.html', rows=rows))
+        """
+        try:
+            for fragment in self.load_template(template_file).stream(kwargs):
+                yield fragment
+        except Exception as e:
+            if self.config['debug']:
+                print(f'Template error: {e}')
+            yield f'<h1>Template Error</h1><p>Error in {template_file}: {str(e)}</p>'
+    
     def get_ip(self):
         return self.config.get('ip', '0.0.0.0')
 
@@ -307,6 +2033,15 @@ class MicroWeb:
                 
             method = request_parts[0]
             full_path = request_parts[1]
+            version = request_parts[2] if len(request_parts) > 2 else 'HTTP/1.0'
+            
+            headers = {}
+            for line in lines[1:]:
+                if not line:
+                    break
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
             
             if self.config['debug']:
                 print(f'Parsed method: {method}, path: {full_path}')
@@ -325,29 +2060,20 @@ class MicroWeb:
                         value = value.replace('%20', ' ').replace('%21', '!').replace('%2B', '+')
                         query_params[key] = value
             
-            post_data = {}
-            if method == 'POST':
-                body_index = request.find('\r\n\r\n')
-                if body_index != -1:
-                    body = request[body_index + 4:]
-                    is_json = 'application/json' in request.lower()
-                    is_form = 'application/x-www-form-urlencoded' in request.lower()
-                    if is_json and body:
-                        try:
-                            post_data = ujson.loads(body)
-                        except:
-                            post_data = {}
-                    elif is_form and body:
-                        for param in body.split('&'):
-                            if '=' in param:
-                                key, value = param.split('=', 1)
-                                post_data[key] = value.replace('%20', ' ')
+            # A body included in the request text is kept; otherwise the server
+            # attaches a reader so the body is only pulled off the socket on demand.
+            body = None
+            body_index = request.find('\r\n\r\n')
+            if body_index != -1 and body_index + 4 < len(request):
+                body = request[body_index + 4:].encode('utf-8')
             
             if self.config['debug']:
                 print(f'Parsed query_params: {query_params}')
-                print(f'Parsed post_data: {post_data}')
             
-            return Request(method, path, query_params, post_data)
+            req = Request(method, path, query_params, None, headers, version, body)
+            req.max_body_size = self.config['max_body_size']
+            req.upload_dir = self.config['upload_dir']
+            return req
             
         except Exception as e:
             if self.config['debug']:
@@ -371,180 +2097,975 @@ class MicroWeb:
         }
         return content_types.get(ext, 'text/plain')
     
-    def match_route(self, path, route_pattern):
-        if route_pattern == path:
-            return True, None
+    def resolve_request(self, req):
+        """Resolve a parsed request to (handler, args), or (None, response) when no handler runs."""
+        # Handle static files with FileResponse
+        response = None
+        if req.path in self.static_files:
+            file_path = self.static_files[req.path]
+            content_type = self.get_content_type(file_path)
+            cache_control = self._static_cache_control.get(req.path, self.config['static_cache_control'])
+            gzip_path = self._static_gzip.get(req.path)
+            if gzip_path is None:
+                response = FileResponse(file_path, content_type, cache_control=cache_control)
+            elif accepts_gzip(req.headers.get('accept-encoding', '')):
+                response = FileResponse(gzip_path, content_type, 'gzip', True, cache_control)
+            else:
+                response = FileResponse(file_path, content_type, vary=True, cache_control=cache_control)
+        else:
+            entry = self._static_index.get(req.path)
+            if entry is not None:
+                content_type, cache_control, plain, gzipped = entry
+                if gzipped is not None and accepts_gzip(req.headers.get('accept-encoding', '')):
+                    variant = gzipped
+                    response = FileResponse(variant[0], content_type, 'gzip', True, cache_control)
+                else:
+                    variant = plain
+                    response = FileResponse(variant[0], content_type, None, gzipped is not None, cache_control)
+                response.size, response.mtime, response.etag, response.head = variant[1:]
         
-        if '<' in route_pattern and '>' in route_pattern:
-            regex_pattern = route_pattern
-            param_pattern = ure.compile(r'<([^>]+)>')
-            regex_pattern = param_pattern.sub(r'([^/]+)', regex_pattern)
-            
-            if not regex_pattern.startswith('^'):
-                regex_pattern = '^' + regex_pattern
-            if not regex_pattern.endswith('$'):
-                regex_pattern = regex_pattern + '$'
-            
-            try:
-                match = ure.match(regex_pattern, path)
-                if match:
-                    return True, match
-            except Exception as e:
-                if self.config['debug']:
-                    print(f'Regex match error: {e}')
-                return False, None
+        if response is not None:
+            response.if_none_match = req.headers.get('if-none-match')
+            response.if_modified_since = req.headers.get('if-modified-since')
+            response.range = req.headers.get('range')
+            response.if_range = req.headers.get('if-range')
+            return None, response
         
-        try:
-            pattern = route_pattern
-            if not pattern.startswith('^'):
-                pattern = '^' + pattern
-            if not pattern.endswith('$'):
-                pattern = pattern + '$'
-            
-            match = ure.match(pattern, path)
-            if match:
-                return True, match
-        except Exception as e:
-            if self.config['debug']:
-                print(f'Direct regex error: {e}')
+        route_config, match_obj, params = self.find_route(req.path)
+        if route_config is None:
+            return None, Response('<h1>404 Not Found</h1><p>Page not found</p>', status=404)
+        
+        if req.method not in route_config['methods']:
+            return None, Response('<h1>405 Method Not Allowed</h1>', status=405)
+        
+        if match_obj is None:
+            return route_config['func'], (req,)
         
-        return False, None
+        for i in range(len(params)):
+            name, converter = params[i]
+            value = match_obj.group(i + 1)
+            req.params[name] = converter(value) if converter else value
+        return route_config['func'], (req, match_obj)
+    
+    def make_response(self, result):
+        """Convert a route handler's return value into a Response."""
+        if isinstance(result, Response):
+            return result
+        elif isinstance(result, str):
+            return Response(result)
+        elif isinstance(result, dict):
+            return self.json_response(result)
+        else:
+            return Response(str(result))
+    
+    def error_response(self, e):
+        if self.config['debug']:
+            print(f'Route handler error: {e}')
+        if isinstance(e, BodyTooLarge):
+            return Response('<h1>413 Payload Too Large</h1>', status=413)
+        return Response(f'<h1>500 Internal Server Error</h1><p>{str(e)}</p>', status=500)
+    
+    def overloaded(self):
+        """True when a new connection should be shed: too many in flight or too little heap."""
+        max_connections = self.config['max_connections']
+        if max_connections and self.active_connections >= max_connections:
+            return True
+        mem_free = getattr(gc, 'mem_free', None)
+        if mem_free is None or mem_free() >= self.config['min_free_memory']:
+            return False
+        if self.gc_policy.pending:
+            self.gc_policy.collect()  # garbage from earlier requests may be all that is missing
+        return mem_free() < self.config['min_free_memory']
+    
+    def shed(self, conn):
+        """Send the prebuilt 503 on a blocking or non-blocking socket without parsing anything."""
+        self.shed_count += 1
+        try:
+            conn.setblocking(False)
+            conn.send(self._shed_response)
+            # Swallow request bytes that already arrived so close() does not reset the connection
+            for _ in range(8):
+                if not recv_into(conn, self._shed_buffer):
+                    break
+        except OSError:
+            pass
+        if self.config['debug']:
+            print(f'Shed connection ({self.active_connections} active)')
     
-    def handle_request(self, request):
-        req = self.parse_request(request)
+    def keep_alive_for(self, req, served):
+        """Decide whether the connection stays open after serving its `served`-th request."""
+        if not self.config['keep_alive'] or served >= self.config['keep_alive_max']:
+            return False
+        connection = req.headers.get('connection', '').lower()
+        if req.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+    
+    def route_request(self, req):
+        """(handler, args, cache key) for a parsed request, shared by dispatch and dispatch_async.
         
+        When no handler is to run (bad request, no route, route cache hit)
+        this is (None, response, None). The cache key is None unless the
+        route's response may be stored by handler_response.
+        """
         if not req:
-            return Response('<h1>400 Bad Request</h1>', status=400).to_http_response()
+            return None, Response('<h1>400 Bad Request</h1>', status=400), None
         
         if self.config['debug']:
             print(f'Request: {req.method} {req.path}')
         
-        # Handle static files with FileResponse
-        if req.path in self.static_files:
-            file_path = self.static_files[req.path]
-            content_type = self.get_content_type(file_path)
-            return FileResponse(file_path, content_type)
+        handler, args = self.resolve_request(req)
+        if handler is None:
+            return None, args, None
+        
+        rule = self._cache_rules.get(handler) if self._cache_rules and req.method == 'GET' else None
+        if rule is None:
+            return handler, args, None
+        key = route_cache_key(req, rule[1])
+        entry = self._route_cache.get(key)
+        if entry is not None:
+            return None, CachedResponse(self._route_cache, key, entry), None
+        return handler, args, key
+    
+    def handler_response(self, req, handler, key, result):
+        """Response for a handler's return value, wrapped for the route cache when key is set."""
+        response = self.make_response(result)
+        response.chunked = req.version != 'HTTP/1.0'
+        if key is not None and response.status == 200 and not response.is_streaming():
+            return CachedResponse(self._route_cache, key, None, response, self._cache_rules[handler][0])
+        return response
+    
+    def dispatch(self, req):
+        """Run the handler for a parsed request; returns a Response or FileResponse."""
+        handler, args, key = self.route_request(req)
+        if handler is None:
+            return args
+        try:
+            result = handler(*args)
+            if is_awaitable(result):
+                # async def handler outside run_async(): drive it on a private event loop
+                result = asyncio.run(result)
+            return self.handler_response(req, handler, key, result)
+        except Exception as e:
+            return self.error_response(e)
+    
+    async def dispatch_async(self, req):
+        """Like dispatch, but awaits async def handlers on the running event loop."""
+        handler, args, key = self.route_request(req)
+        if handler is None:
+            return args
+        try:
+            result = handler(*args)
+            if is_awaitable(result):
+                result = await result
+            return self.handler_response(req, handler, key, result)
+        except Exception as e:
+            return self.error_response(e)
+    
+    def serialize(self, response, keep_alive=None):
+        """HTTP bytes for a plain Response; FileResponse and streaming responses are returned as-is."""
+        if isinstance(response, CachedResponse):
+            return response.data(keep_alive)
+        if isinstance(response, FileResponse) or response.is_streaming():
+            return response
+        return response.to_http_response(keep_alive)
+    
+    def handle_request(self, request, keep_alive=None):
+        req = request if isinstance(request, Request) else self.parse_request(request)
+        return self.serialize(self.dispatch(req), keep_alive)
+    
+    async def handle_request_async(self, request, keep_alive=None):
+        """Like handle_request, but awaits async def handlers on the running event loop."""
+        req = request if isinstance(request, Request) else self.parse_request(request)
+        return self.serialize(await self.dispatch_async(req), keep_alive)
+    
+    def static_file_headers(self, response, keep_alive=None):
+        """Build the header block for a FileResponse.
+        
+        Returns (headers, start, length) describing the slice of the file to
+        send, or None if the file is unreadable. A request whose validators
+        still match gets a 304 with length 0, so the file is never opened; a
+        single satisfiable Range gets a 206 for just that slice.
+        """
+        if response.size is not None:
+            return self.file_headers(response, response.size, response.mtime, keep_alive)
+        try:
+            stat = os.stat(response.file_path)
+        except Exception as e:
+            if self.config['debug']:
+                print(f'File access error: {e}')
+            return None
+        return self.file_headers(response, stat[6], stat[8], keep_alive)
+    
+    def file_headers(self, response, file_size, mtime, keep_alive=None, conditional=True):
+        """Header block for a file of known size and mtime; see static_file_headers.
+        
+        With conditional=False the request's validators and Range are ignored
+        and the plain 200 header block is built.
+        """
+        if response.head is not None and (not conditional or (
+                response.range is None and response.if_none_match is None and response.if_modified_since is None)):
+            return response.head + HEAD_ENDINGS[keep_alive], 0, file_size
+        
+        etag = response.etag or f'"{mtime:x}-{file_size:x}"'
+        last_modified = http_date(mtime) if mtime > 0 else None
         
-        for route_pattern, route_config in self.routes.items():
-            is_match, match_obj = self.match_route(req.path, route_pattern)
+        # If-None-Match wins over If-Modified-Since when both are sent
+        if not conditional:
+            not_modified = False
+        elif response.if_none_match is not None:
+            not_modified = etag_matches(response.if_none_match, etag)
+        else:
+            not_modified = last_modified is not None and response.if_modified_since == last_modified
+        
+        # A Range only applies while If-Range (when sent) still names this version
+        byte_range = None
+        if conditional and response.range is not None and not not_modified:
+            if response.if_range is None or response.if_range in (etag, last_modified):
+                byte_range = parse_range(response.range, file_size)
+        
+        start = 0
+        length = file_size
+        if not_modified:
+            parts = [STATUS_LINES[304]]
+            length = 0
+        elif byte_range is False:
+            parts = [STATUS_LINES[416],
+                     'Content-Range: bytes */', str(file_size), '\r\n',
+                     'Content-Length: 0\r\n']
+            length = 0
+        else:
+            if byte_range is None:
+                parts = [STATUS_LINES[200]]
+            else:
+                start = byte_range[0]
+                length = byte_range[1] - start + 1
+                parts = [STATUS_LINES[206],
+                         f'Content-Range: bytes {start}-{byte_range[1]}/{file_size}\r\n']
+            parts += ['Content-Type: ', response.content_type, '\r\n',
+                      'Content-Length: ', str(length), '\r\n',
+                      'Accept-Ranges: bytes\r\n',
+                      'Access-Control-Allow-Origin: *\r\n']
+        parts.append(f'ETag: {etag}\r\n')
+        if last_modified is not None:
+            parts.append(f'Last-Modified: {last_modified}\r\n')
+        if response.cache_control:
+            parts.append(f'Cache-Control: {response.cache_control}\r\n')
+        if response.content_encoding:
+            parts.append(f'Content-Encoding: {response.content_encoding}\r\n')
+        if response.vary:
+            parts.append('Vary: Accept-Encoding\r\n')
+        if keep_alive is not None:
+            parts.append(connection_header(keep_alive))
+        parts.append('\r\n')
+        return ''.join(parts).encode('utf-8'), start, length
+    
+    def cached_file_response(self, response, keep_alive=None):
+        """Complete response bytes for a small static file from the in-RAM
+        cache, loading it on first use; None when the file must be streamed
+        from flash (cache disabled, file too large or unreadable)."""
+        cache = self._static_cache
+        if cache is None:
+            return None
+        
+        if response.size is None:
+            # Recorded on the response, so static_file_headers() need not stat again
+            try:
+                stat = os.stat(response.file_path)
+            except OSError:
+                return None
+            response.size, response.mtime = stat[6], stat[8]
+        if response.size > cache.max_file_size:
+            return None  # never cached, so not counted as a miss either
+        
+        key = (response.file_path, response.cache_control)
+        entry = cache.get(key)
+        if entry is not None and entry[0] != response.mtime:
+            cache.remove(key)  # the file was replaced on flash
+            entry = None
+        if entry is None:
+            try:
+                with open(response.file_path, 'rb') as f:
+                    body = f.read()
+            except OSError:
+                return None
+            head = self.file_headers(response, len(body), response.mtime, None, False)[0][:-2]
+            entry = cache.put(key, response.mtime, head, body)
+        
+        mtime, head, body = entry[0], entry[1], entry[2]
+        if response.range is None and response.if_none_match is None and response.if_modified_since is None:
+            return head + HEAD_ENDINGS[keep_alive] + body
+        headers, start, length = self.file_headers(response, len(body), mtime, keep_alive)
+        return headers + body[start:start + length]
+    
+    def clear_static_cache(self):
+        """Drop all cached static files, e.g. after replacing them on flash."""
+        if self._static_cache is not None:
+            self._static_cache.clear()
+    
+    def file_not_found(self):
+        return Response('<h1>404 Not Found</h1><p>File not found</p>', status=404)
+    
+    def send_response(self, conn, response, keep_alive=None):
+        """Write a response to a blocking socket; returns whether the connection may be reused."""
+        if isinstance(response, FileResponse):
+            # Handle static file response
+            data = self.cached_file_response(response, keep_alive)
+            if data is not None:
+                conn.sendall(data)
+                return keep_alive
             
-            if is_match:
-                if req.method not in route_config['methods']:
-                    return Response('<h1>405 Method Not Allowed</h1>', 
-                                  status=405).to_http_response()
-                
-                try:
-                    if match_obj and hasattr(match_obj, 'group'):
-                        result = route_config['func'](req, match_obj)
-                    else:
-                        result = route_config['func'](req)
-                    
-                    if isinstance(result, Response):
-                        return result.to_http_response()
-                    elif isinstance(result, str):
-                        return Response(result).to_http_response()
-                    elif isinstance(result, dict):
-                        return self.json_response(result).to_http_response()
-                    else:
-                        return Response(str(result)).to_http_response()
-                        
-                except Exception as e:
-                    if self.config['debug']:
-                        print(f'Route handler error: {e}')
-                    return Response(f'<h1>500 Internal Server Error</h1><p>{str(e)}</p>', 
-                                  status=500).to_http_response()
+            file_headers = self.static_file_headers(response, keep_alive)
+            if file_headers is None:
+                return self.send_response(conn, self.file_not_found(), keep_alive)
+            
+            header_response, start, length = file_headers
+            if not length:
+                conn.sendall(header_response)
+            else:
+                self.send_file(conn, response.file_path, header_response, start, length)
+            
+            if self.config['debug']:
+                print(f'Served static: {response.file_path} ({length} bytes)')
+        
+        elif isinstance(response, CachedResponse):
+            conn.sendall(response.data(keep_alive))
         
-        return Response('<h1>404 Not Found</h1><p>Page not found</p>', 
-                      status=404).to_http_response()
+        elif response.is_streaming():
+            # Streaming response: chunked for HTTP/1.1, close-delimited otherwise
+            if not response.chunked:
+                keep_alive = False
+            conn.sendall(response.header_block(keep_alive))
+            for piece in response.iter_body():
+                conn.sendall(piece)
+        
+        else:
+            body = response.body_bytes()
+            header_response = response.header_block(keep_alive, len(body))
+            if len(body) <= COALESCE_SIZE:
+                conn.sendall(header_response + bytes(body))
+            else:
+                conn.sendall(header_response)
+                conn.sendall(body)
+        return keep_alive
     
-
+    def send_file(self, conn, file_path, header_response, start, length):
+        """Send headers and `length` bytes of a file from `start` through one
+        reused buffer; the first chunk shares a write with the headers when
+        they fit."""
+        if self._file_buffer is None:
+            self._file_buffer = bytearray(1024)
+        buf = self._file_buffer
+        mv = memoryview(buf)
+        
+        with open(file_path, 'rb') as f:
+            if start:
+                f.seek(start)
+            offset = 0
+            if len(header_response) < len(buf):
+                offset = len(header_response)
+                buf[:offset] = header_response
+            else:
+                conn.sendall(header_response)
+            while True:
+                n = f.readinto(mv[offset:offset + min(len(buf) - offset, length)]) if length else 0
+                if not n and not offset:
+                    break
+                conn.sendall(mv[:offset + (n or 0)])
+                if not n:
+                    break
+                length -= n
+                offset = 0
     
-    def run(self):
+    def run(self, mode='sync'):
+        if mode == 'async':
+            return self.run_async()
+        if mode == 'poll':
+            return self.run_poll()
+        
         s = socket.socket()
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind(('0.0.0.0', self.config['port']))
         s.listen(5)
+        if self.gc_policy.idle_timeout:
+            s.settimeout(self.gc_policy.idle_timeout)
+        reader = RequestReader(self.config['max_header_size'])
+        # Watches a kept-alive connection and the listener together, see keep_alive_wait()
+        poller = select.poll()
+        poller.register(s, select.POLLIN)
         
         if self.config['debug']:
             print(f"MicroWeb running on http://0.0.0.0:{self.config['port']}")
         
         while True:
             conn = None
+            served = 0
             try:
-                conn, addr = s.accept()
+                try:
+                    conn, addr = s.accept()
+                except OSError:
+                    # Nothing to accept for a while: a cheap moment to collect
+                    self.gc_policy.idle()
+                    continue
+                if self.overloaded():
+                    self.shed(conn)
+                    continue
                 conn.settimeout(5.0)
                 
                 if self.config['debug']:
                     print(f'Connection from {addr}')
                 
-                request_data = b''
+                reader.reset()
+                served = 0
+                poller.register(conn, select.POLLIN)
                 while True:
                     try:
-                        chunk = conn.recv(1024)
-                        if not chunk:
-                            break
-                        request_data += chunk
-                        if b'\r\n\r\n' in request_data:
-                            break
-                    except:
+                        request = reader.read_request(conn)
+                    except HeaderTooLarge:
+                        conn.sendall(Response('<h1>431 Request Header Fields Too Large</h1>',
+                                           status=431).to_http_response(False))
+                        break
+                    if not request:
                         break
-                
-                if request_data:
-                    request = request_data.decode('utf-8')
-                    response = self.handle_request(request)
                     
-                    if isinstance(response, FileResponse):
-                        # Handle static file response
-                        try:
-                            file_size = os.stat(response.file_path)[6]  # Get file size
-                        except Exception as e:
-                            if self.config['debug']:
-                                print(f'File access error: {e}')
-                            error_response = Response('<h1>404 Not Found</h1><p>File not found</p>', 
-                                                    status=404).to_http_response()
-                            conn.send(error_response.encode('utf-8'))
-                            continue
-                        
-                        headers = {
-                            'Content-Type': response.content_type,
-                            'Content-Length': str(file_size),
-                            'Access-Control-Allow-Origin': '*',
-                            'Cache-Control': 'public, max-age=20'
-                        }
-                        header_response = 'HTTP/1.1 200 OK\r\n'
-                        for key, value in headers.items():
-                            header_response += f'{key}: {value}\r\n'
-                        header_response += '\r\n'
-                        conn.send(header_response.encode('utf-8'))
-                        
-                        # Send file in chunks
-                        with open(response.file_path, 'rb') as f:
-                            while True:
-                                chunk = f.read(1024)
-                                if not chunk:
-                                    break
-                                conn.send(chunk)
-                        
-                        if self.config['debug']:
-                            print(f'Served static: {response.file_path} ({file_size} bytes)')
+                    req = self.parse_request(request)
+                    if req is not None:
+                        req._read = reader.read_body
+                    served += 1
+                    keep_alive = req is not None and self.keep_alive_for(req, served)
+                    response = self.dispatch(req)
+                    if keep_alive and not reader.body_fits(self.config['max_body_size']):
+                        # Decide before the Connection header goes out: a too-large body is not
+                        # drained, and an open chunked body has to be drained now to find out
+                        keep_alive = not reader.body_done and reader.drain_body(self.config['max_body_size'])
+                    keep_alive = self.send_response(conn, response, keep_alive)
                     
-                    else:
-                        # Handle regular string response
-                        if isinstance(response, str):
-                            response = response.encode('utf-8')
-                        sent = 0
-                        while sent < len(response):
-                            chunk = response[sent:sent + 1024]
-                            conn.send(chunk)
-                            sent += len(chunk)
+                    # Skip whatever body the handler left unread before the next request
+                    if not keep_alive or not reader.drain_body(self.config['max_body_size']):
+                        break
+                    if not self.keep_alive_wait(poller, s, reader):
+                        break
                 
             except Exception as e:
                 if self.config['debug']:
                     print(f'Request handling error: {e}')
             finally:
                 if conn:
+                    try:
+                        poller.unregister(conn)
+                    except:
+                        pass
                     try:
                         conn.close()
                     except:
                         pass
-                gc.collect()  # Clear memory
\ No newline at end of file
+                    self.gc_policy.after_requests(served or 1)
+    
+    def keep_alive_wait(self, poller, listener, reader):
+        """Wait for the next request on a kept-alive connection of the blocking server.
+        
+        A serial server must not sit on a quiet client while others queue, so
+        this gives up, and the connection is closed, as soon as another client
+        is waiting on the listener or after at most SYNC_KEEP_ALIVE_IDLE
+        seconds (keep_alive_timeout if shorter). True when the client sent
+        more (or closed, which read_request then reports).
+        """
+        if reader.end > reader.start:
+            return True  # a pipelined request is already buffered
+        listen_key = poll_key(listener)
+        timeout = int(min(self.config['keep_alive_timeout'], SYNC_KEEP_ALIVE_IDLE) * 1000)
+        start = ticks_ms()
+        while True:
+            remaining = timeout - ticks_diff(ticks_ms(), start)
+            if remaining <= 0:
+                return False
+            waiting = False
+            for event in poller.poll(remaining):
+                if event[0] is listener or event[0] == listen_key:
+                    waiting = True
+                else:
+                    return True
+            if waiting:
+                return False
+    
+    def run_poll(self):
+        """Serve many connections from one thread with select.poll.
+        
+        Every client gets a PollConnection state machine, so a slow upload or
+        file download only advances when its socket is ready and never holds
+        up the accept queue. Bodies are collected before the handler runs, as
+        in async mode; handlers themselves still run to completion.
+        """
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(('0.0.0.0', self.config['port']))
+        s.listen(5)
+        s.setblocking(False)
+        
+        poller = select.poll()
+        poller.register(s, select.POLLIN)
+        listen_key = poll_key(s)
+        self._poller = poller
+        self._poll_conns = {}
+        policy = self.gc_policy
+        last_sweep = ticks_ms()
+        
+        if self.config['debug']:
+            print(f"MicroWeb (poll) running on http://0.0.0.0:{self.config['port']}")
+        
+        while True:
+            events = poller.poll(500)
+            for event in events:
+                key, flags = event[0], event[1]
+                if key is s or key == listen_key:
+                    self.poll_accept(s)
+                    continue
+                c = self._poll_conns.get(key)
+                if c is None:
+                    continue
+                try:
+                    if c.state in ('headers', 'body'):
+                        if flags & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                            if not self.poll_read(c):
+                                continue
+                    elif flags & (select.POLLHUP | select.POLLERR):
+                        self.poll_close(c)
+                        continue
+                    self.poll_process(c)
+                except Exception as e:
+                    if self.config['debug']:
+                        print(f'Request handling error: {e}')
+                    self.poll_close(c)
+            
+            now = ticks_ms()
+            if ticks_diff(now, last_sweep) >= 500:
+                last_sweep = now
+                self.poll_sweep(now)
+            if not events and not self._poll_conns and policy.idle_timeout:
+                if ticks_diff(now, policy.last_activity) >= policy.idle_timeout * 1000:
+                    policy.idle()
+    
+    def poll_accept(self, s):
+        try:
+            conn, addr = s.accept()
+        except OSError:
+            return
+        conn.setblocking(False)
+        if self.overloaded():
+            self.shed(conn)
+            conn.close()
+            return
+        self.active_connections += 1
+        c = PollConnection(conn, self.config['max_header_size'])
+        c.events = select.POLLIN
+        self._poller.register(conn, select.POLLIN)
+        self._poll_conns[conn] = c
+        self._poll_conns[poll_key(conn)] = c
+        if self.config['debug']:
+            print(f'Connection from {addr}')
+    
+    def poll_close(self, c):
+        if c.state == 'closed':
+            return
+        c.state = 'closed'
+        self.active_connections -= 1
+        if c.source is not None and hasattr(c.source, 'close'):
+            c.source.close()  # closes a file left open by file_chunks()
+        if isinstance(c.body, MultipartParser) and c.body.part_file is not None:
+            c.body.part_file.close()
+        try:
+            self._poller.unregister(c.sock)
+        except:
+            pass
+        self._poll_conns.pop(c.sock, None)
+        self._poll_conns.pop(poll_key(c.sock), None)
+        try:
+            c.sock.close()
+        except:
+            pass
+        self.gc_policy.after_requests(c.served or 1)
+    
+    def poll_sweep(self, now):
+        """Close connections that made no progress within their timeout."""
+        idle_ms = int(self.config['keep_alive_timeout'] * 1000)
+        for c in list(self._poll_conns.values()):
+            if c.state == 'closed':
+                continue
+            waiting_for_next = c.state == 'headers' and c.served and not c.end
+            limit = idle_ms if waiting_for_next else 5000
+            if ticks_diff(now, c.last_active) > limit:
+                self.poll_close(c)
+    
+    def poll_read(self, c):
+        """Receive into the connection's buffer; False if it was closed."""
+        if c.end == len(c.buf):
+            return True  # full: let poll_process act on it (431 or framing error)
+        try:
+            if hasattr(c.sock, 'recv_into'):
+                n = c.sock.recv_into(c.mv[c.end:])
+            else:
+                n = c.sock.readinto(c.mv[c.end:])
+        except OSError as e:
+            if e.args and e.args[0] == errno.EAGAIN:
+                return True
+            self.poll_close(c)
+            return False
+        if n is None:
+            return True  # MicroPython: nothing to read yet
+        if n == 0:
+            self.poll_close(c)
+            return False
+        c.end += n
+        c.last_active = ticks_ms()
+        return True
+    
+    def poll_process(self, c):
+        """Advance a connection's state machine as far as its buffer and socket allow."""
+        while c.state != 'closed':
+            if c.state == 'headers':
+                progressed = self.poll_headers(c)
+            elif c.state == 'body':
+                progressed = self.poll_body(c)
+            else:
+                progressed = self.poll_write(c)
+            if not progressed:
+                break
+        
+        if c.state != 'closed':
+            events = select.POLLOUT if c.state in ('write', 'stream') else select.POLLIN
+            if events != c.events:
+                self._poller.modify(c.sock, events)
+                c.events = events
+    
+    def poll_headers(self, c):
+        header_end = find_header_end(c.buf, c.scan, c.end)
+        if header_end == -1:
+            if c.end == len(c.buf):
+                self.poll_start(c, Response('<h1>431 Request Header Fields Too Large</h1>', status=431), False)
+                return True
+            c.scan = c.end
+            return False
+        
+        try:
+            header_text = str(c.mv[:header_end], 'utf-8')
+        except UnicodeError:
+            header_text = ''
+        c.consume(header_end)
+        c.scan = 0
+        req = self.parse_request(header_text)
+        c.req = req
+        if req is None:
+            self.poll_respond(c)
+            return True
+        
+        limit = self.config['max_body_size']
+        content_type = req.headers.get('content-type', '')
+        c.chunk_state = None
+        c.body = bytearray()
+        try:
+            c.body_left = int(req.headers.get('content-length', 0) or 0)
+        except ValueError:
+            c.body_left = 0
+        if 'chunked' in req.headers.get('transfer-encoding', '').lower():
+            c.chunk_state = 'size'
+            c.body_left = 0
+        elif 'multipart/form-data' in content_type:
+            c.body = self.multipart_parser(content_type)
+        elif c.body_left > limit:
+            self.poll_start(c, Response('<h1>413 Payload Too Large</h1>', status=413), False)
+            return True
+        c.state = 'body'
+        return True
+    
+    def poll_body(self, c):
+        try:
+            if not c.feed_body(self.config['max_body_size']):
+                return False
+            req = c.req
+            if isinstance(c.body, MultipartParser):
+                req.finish_multipart(c.body)
+                req._body = b''
+            else:
+                req._body = bytes(c.body)
+        except BodyTooLarge:
+            self.poll_start(c, Response('<h1>413 Payload Too Large</h1>', status=413), False)
+            return True
+        except ValueError as e:
+            self.poll_start(c, Response(f'<h1>400 Bad Request</h1><p>{e}</p>', status=400), False)
+            return True
+        c.body = None
+        self.poll_respond(c)
+        return True
+    
+    def poll_respond(self, c):
+        c.served += 1
+        req = c.req
+        keep_alive = req is not None and self.keep_alive_for(req, c.served)
+        self.poll_start(c, self.dispatch(req), keep_alive)
+    
+    def poll_start(self, c, response, keep_alive):
+        """Queue a response on a connection: header block plus body or chunk source."""
+        source = None
+        if isinstance(response, FileResponse):
+            data = self.cached_file_response(response, keep_alive)
+            if data is None:
+                file_headers = self.static_file_headers(response, keep_alive)
+                if file_headers is None:
+                    return self.poll_start(c, self.file_not_found(), keep_alive)
+                data, start, length = file_headers
+                if length:
+                    source = file_chunks(response.file_path, start, length)
+            if self.config['debug']:
+                print(f'Served static: {response.file_path}')
+        elif isinstance(response, CachedResponse):
+            data = response.data(keep_alive)
+        elif response.is_streaming():
+            if not response.chunked:
+                keep_alive = False
+            data = response.header_block(keep_alive)
+            source = response.iter_body()
+        else:
+            body = response.body_bytes()
+            data = response.header_block(keep_alive, len(body)) + bytes(body)
+        
+        c.out = memoryview(data)
+        c.source = source
+        c.keep_alive = keep_alive
+        c.state = 'write'
+    
+    def poll_write(self, c):
+        """Send as much as the socket takes; True once the response is complete."""
+        while True:
+            if not len(c.out):
+                if c.source is None:
+                    break
+                try:
+                    c.out = memoryview(next(c.source))
+                    c.state = 'stream'
+                except StopIteration:
+                    c.source = None
+                continue
+            try:
+                n = c.sock.send(c.out)
+            except OSError as e:
+                if e.args and e.args[0] == errno.EAGAIN:
+                    return False
+                self.poll_close(c)
+                return False
+            if not n:
+                return False
+            c.out = c.out[n:]
+            c.last_active = ticks_ms()
+        
+        if not c.keep_alive:
+            self.poll_close(c)
+            return False
+        c.state = 'headers'
+        c.req = None
+        c.out = None
+        return True
+    
+    def run_async(self):
+        """Serve connections concurrently on the (u)asyncio event loop."""
+        asyncio.run(self.serve_async())
+    
+    async def serve_async(self):
+        server = await asyncio.start_server(self.handle_client_async, '0.0.0.0',
+                                            self.config['port'], backlog=5)
+        
+        if self.config['debug']:
+            print(f"MicroWeb (async) running on http://0.0.0.0:{self.config['port']}")
+        
+        policy = self.gc_policy
+        try:
+            while True:
+                await asyncio.sleep(policy.idle_timeout or 3600)
+                if policy.idle_timeout and ticks_diff(ticks_ms(), policy.last_activity) >= policy.idle_timeout * 1000:
+                    policy.idle()
+        finally:
+            server.close()
+            await server.wait_closed()
+    
+    async def read_request_async(self, reader, timeout=5.0):
+        """Read the request line and headers from a stream."""
+        request_data = b''
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                return request_data
+            request_data += line
+            if len(request_data) > self.config['max_header_size']:
+                raise HeaderTooLarge()
+            if line == b'\r\n':
+                break
+        return request_data
+    
+    def multipart_parser(self, content_type):
+        """Parser for a multipart body read by the poll or async server, streaming uploads
+        straight to the filesystem instead of buffering them."""
+        return MultipartParser(multipart_boundary(content_type), self.config['upload_dir'],
+                               self.config['max_body_size'])
+    
+    async def read_body_async(self, reader, req, timeout=5.0):
+        """Read a Content-Length or chunked body, up to max_body_size, before dispatch."""
+        limit = self.config['max_body_size']
+        chunked = 'chunked' in req.headers.get('transfer-encoding', '').lower()
+        content_type = req.headers.get('content-type', '')
+        if 'multipart/form-data' in content_type and not chunked:
+            parser = self.multipart_parser(content_type)
+            remaining = int(req.headers.get('content-length', 0) or 0)
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(512, remaining)), timeout)
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                parser.feed(chunk)
+            req.finish_multipart(parser)
+            return b''
+        
+        if chunked:
+            chunks = []
+            total = 0
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                try:
+                    size = int(line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    size = 0
+                if size == 0:
+                    # Last chunk: skip any trailer headers up to the blank line
+                    while (await asyncio.wait_for(reader.readline(), timeout)).strip():
+                        pass
+                    break
+                total += size
+                if total > limit:
+                    raise BodyTooLarge()
+                chunks.append(await asyncio.wait_for(reader.readexactly(size), timeout))
+                await asyncio.wait_for(reader.readline(), timeout)
+            return b''.join(chunks)
+        
+        length = int(req.headers.get('content-length', 0) or 0)
+        if length > limit:
+            raise BodyTooLarge()
+        if length > 0:
+            return await asyncio.wait_for(reader.readexactly(length), timeout)
+        return b''
+    
+    async def send_response_async(self, writer, response, keep_alive=None):
+        """Write a response to a stream; returns whether the connection may be reused."""
+        if isinstance(response, FileResponse):
+            data = self.cached_file_response(response, keep_alive)
+            if data is not None:
+                writer.write(data)
+                await writer.drain()
+                return keep_alive
+            
+            file_headers = self.static_file_headers(response, keep_alive)
+            if file_headers is None:
+                return await self.send_response_async(writer, self.file_not_found(), keep_alive)
+            
+            header_response, start, length = file_headers
+            writer.write(header_response)
+            
+            # Drain after every chunk so other connections get a turn
+            if length:
+                with open(response.file_path, 'rb') as f:
+                    if start:
+                        f.seek(start)
+                    remaining = length
+                    while remaining:
+                        chunk = f.read(min(1024, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        writer.write(chunk)
+                        await writer.drain()
+            
+            if self.config['debug']:
+                print(f'Served static: {response.file_path} ({length} bytes)')
+        
+        elif isinstance(response, CachedResponse):
+            writer.write(response.data(keep_alive))
+        
+        elif response.is_streaming():
+            if not response.chunked:
+                keep_alive = False
+            writer.write(response.header_block(keep_alive))
+            for piece in response.iter_body():
+                writer.write(piece)
+                await writer.drain()
+        
+        else:
+            body = response.body_bytes()
+            writer.write(response.header_block(keep_alive, len(body)))
+            writer.write(body if isinstance(body, bytes) else bytes(body))
+        await writer.drain()
+        return keep_alive
+    
+    async def handle_client_async(self, reader, writer):
+        if self.overloaded():
+            self.shed_count += 1
+            try:
+                writer.write(self._shed_response)
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+            return
+        
+        self.active_connections += 1
+        served = 0
+        try:
+            if self.config['debug']:
+                print(f"Connection from {writer.get_extra_info('peername')}")
+            
+            timeout = 5.0
+            while True:
+                try:
+                    request_data = await self.read_request_async(reader, timeout)
+                except asyncio.TimeoutError:
+                    break
+                except HeaderTooLarge:
+                    writer.write(Response('<h1>431 Request Header Fields Too Large</h1>',
+                                          status=431).to_http_response(False))
+                    await writer.drain()
+                    break
+                if not request_data:
+                    break
+                
+                request = request_data.decode('utf-8')
+                req = self.parse_request(request)
+                if req is not None:
+                    try:
+                        req._body = await self.read_body_async(reader, req, timeout)
+                    except BodyTooLarge:
+                        writer.write(Response('<h1>413 Payload Too Large</h1>',
+                                              status=413).to_http_response(False))
+                        await writer.drain()
+                        break
+                    except ValueError as e:
+                        writer.write(Response(f'<h1>400 Bad Request</h1><p>{e}</p>',
+                                              status=400).to_http_response(False))
+                        await writer.drain()
+                        break
+                served += 1
+                keep_alive = req is not None and self.keep_alive_for(req, served)
+                response = await self.dispatch_async(req)
+                keep_alive = await self.send_response_async(writer, response, keep_alive)
+                
+                if not keep_alive:
+                    break
+                timeout = self.config['keep_alive_timeout']
+        
+        except Exception as e:
+            if self.config['debug']:
+                print(f'Request handling error: {e}')
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+            self.active_connections -= 1
+            self.gc_policy.after_requests(served or 1)
@@ -2,8 +2,12 @@ import subprocess
 import os
 import serial.tools.list_ports
 
-def upload_file(file_path, port=None,destination=None):
-    """Upload a file to the ESP32 filesystem using mpremote."""
+def upload_file(file_path, port=None,destination=None, keep_path=False):
+    """Upload a file to the ESP32 filesystem using mpremote.
+    
+    The file goes to the root under its own name unless keep_path is set,
+    in which case it is written to `destination` (its directory must exist).
+    """
     if not port:
         ports = [p.device for p in serial.tools.list_ports.comports()]
         port = ports[0] if ports else None
@@ -11,20 +15,23 @@ def upload_file(file_path, port=None,destination=None):
         raise Exception("No ESP32 found. Specify --port.")
     
     file_name = file_path.split('/')[-1].split('\\')[-1]
+    remote_path = destination if keep_path and destination else file_name
+    remote_dir = remote_path.rsplit('/', 1)[0] if '/' in remote_path else ''
+    file_name = remote_path.split('/')[-1]
     
     try:
         if not os.path.exists(file_path):
             raise Exception(f"File {file_path} does not exist.")
         
         # Use mpremote to copy the file
-        cmd = ['mpremote', 'connect', port, 'cp', file_path, f':{file_name}']
+        cmd = ['mpremote', 'connect', port, 'cp', file_path, f':{remote_path}']
         result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
         
         if result.returncode != 0:
             raise Exception(f"mpremote failed: {result.stderr}")
         
         # Verify file was uploaded
-        verify_cmd = ['mpremote', 'connect', port, 'ls']
+        verify_cmd = ['mpremote', 'connect', port, 'ls'] + ([f':{remote_dir}'] if remote_dir else [])
         verify_result = subprocess.run(verify_cmd, capture_output=True, text=True, timeout=10)
         
         if verify_result.returncode == 0 and file_name in verify_result.stdout: